@@ -0,0 +1,149 @@
+"""
+Latency of the /callback data path: the original three sequential registry
+and transaction queries with full pydantic re-validation, against the cached
+single lookup with a projected transaction query and model_construct.
+
+    python benchmarks/callback_bench.py --mock --rtt-ms 1
+    python benchmarks/callback_bench.py --url mongodb://localhost:27017
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DB_NAME', 'bench_database')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from db import Database
+from registry_cache import RegistryCache
+from db_bench import SlowCollection
+from main import (CallbackResponse, Properties, TransactionNotificationDetail,
+                  TRANSACTION_DETAIL_PROJECTION)
+
+DB_NAME = 'bench_database'
+
+class SlowCursorCollection(SlowCollection):
+
+    def find(self, *args, **kwargs):
+        time.sleep(self.rtt)
+        return self.collection.find(*args, **kwargs)
+
+def seed(db, terminals, per_terminal):
+    db.registry.delete_many({})
+    db.transactions.delete_many({})
+    db.registry.insert_many([
+        {
+            "fonepay": {"merchantId": "M00000001", "terminalId": f"T{i:08d}"},
+            "machineIdentifier": f"machine-{i}",
+            "enabledServices": ['IPN']
+        }
+        for i in range(terminals)
+    ])
+    now = datetime.now()
+    db.transactions.insert_many([
+        {
+            "mobileNumber": "9849669934",
+            "merchantId": "M00000001",
+            "terminalId": f"T{i:08d}",
+            "retrievalReferenceNumber": f"{i}{n}",
+            "amount": "40.0",
+            "remark1": "Message to send",
+            "type": "alert",
+            "uniqueId": f"{i}-{n}",
+            "properties": {
+                "commission": 0.0,
+                "sessionSrlNo": "69",
+                "txnDate": now,
+                "secondaryMobileNumber": "9012932645",
+                "email": None,
+                "initiator": "98xxxxxxxx"
+            },
+            "timestamp": now - timedelta(seconds=n)
+        }
+        for i in range(terminals)
+        for n in range(per_terminal)
+    ])
+
+async def legacy_callback(db, merchant_id, terminal_id):
+    await db.find_merchant(merchant_id)
+    await db.find_device(merchant_id, terminal_id)
+    transactions = await db.recent_transactions(merchant_id, terminal_id, limit=5)
+    details = []
+    for transaction in transactions:
+        transaction['_id'] = str(transaction['_id'])
+        details.append(TransactionNotificationDetail(
+            mobileNumber=transaction['mobileNumber'],
+            merchantId=transaction['merchantId'],
+            terminalId=transaction['terminalId'],
+            retrievalReferenceNumber=transaction['retrievalReferenceNumber'],
+            amount=transaction['amount'],
+            remark1=transaction['remark1'],
+            type=transaction.get('type'),
+            uniqueId=transaction['uniqueId'],
+            properties=Properties(**transaction['properties']) if transaction.get('properties') else None
+        ))
+    return CallbackResponse(transactionNotificationDetails=details).model_dump_json()
+
+async def cached_callback(db, cache, merchant_id, terminal_id):
+    await cache.get_device(merchant_id, terminal_id)
+    transactions = await db.recent_transactions(
+        merchant_id, terminal_id, limit=5, projection=TRANSACTION_DETAIL_PROJECTION
+    )
+    details = [
+        TransactionNotificationDetail.model_construct(
+            **dict(transaction, properties=Properties.model_construct(**transaction['properties']))
+        )
+        for transaction in transactions
+    ]
+    return CallbackResponse.model_construct(transactionNotificationDetails=details).model_dump_json()
+
+async def measure(label, call, requests, terminals):
+    samples = []
+    for i in range(requests):
+        started = time.perf_counter()
+        await call("M00000001", f"T{i % terminals:08d}")
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(f"{label:<8} p50 {statistics.median(samples):7.3f} ms  p99 {p99:7.3f} ms  ({requests} calls)")
+
+async def main(args):
+    if args.mock:
+        import mongomock
+        db = Database(name=DB_NAME, client=mongomock.MongoClient())
+    else:
+        db = Database(url=args.url, name=DB_NAME)
+    await db.connect()
+    if db.is_async:
+        # Seed through a synchronous client
+        from pymongo import MongoClient
+        sync = Database(name=DB_NAME, client=MongoClient(args.url))
+        await sync.connect()
+        seed(sync, args.terminals, args.per_terminal)
+        await sync.close()
+    else:
+        seed(db, args.terminals, args.per_terminal)
+    await db.ensure_indexes()
+
+    if args.mock:
+        rtt = args.rtt_ms / 1000
+        db.registry = SlowCollection(db.registry, rtt)
+        db.transactions = SlowCursorCollection(db.transactions, rtt)
+
+    cache = RegistryCache(db)
+    await measure('legacy', lambda m, t: legacy_callback(db, m, t), args.requests, args.terminals)
+    await measure('cached', lambda m, t: cached_callback(db, cache, m, t), args.requests, args.terminals)
+    await db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='mongodb://localhost:27017/')
+    parser.add_argument('--mock', action='store_true', help='use mongomock instead of a local mongod')
+    parser.add_argument('--rtt-ms', type=float, default=1.0, help='simulated round trip for --mock')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--terminals', type=int, default=100)
+    parser.add_argument('--per-terminal', type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,63 @@
+"""
+Queue message format: encode and decode cost on one core and payload size,
+comparing the original JSON messages with the versioned msgpack format.
+
+    python benchmarks/codec_bench.py --seconds 1 --messages 1000000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import codec
+
+MESSAGE = {
+    'amount': '40.0',
+    'mobileNumber': '9849669934',
+    'email': 'pokharelsamir246@gmail.com',
+    'merchantId': 'M1',
+    'terminalId': 'T1',
+    'commission': 0.0,
+    'machineIdentifier': 'mid-0001',
+    'enabledServices': ['IPN', 'EMAIL', 'SMS']
+}
+
+def legacy_encode():
+    return json.dumps(MESSAGE).encode()
+
+def legacy_decode(body):
+    return json.loads(body.decode('utf-8'))
+
+def measure(label, fn, args):
+    count = 0
+    deadline = time.perf_counter() + args.seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            fn()
+        count += 1000
+    rate = count / args.seconds
+    print(f"{label:<16} {rate:>10.0f} ops/s  ({1e6 / rate:.2f} us each)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=1.0)
+    parser.add_argument('--messages', type=int, default=1000000, help='queue depth used for the size estimate')
+    args = parser.parse_args()
+
+    legacy_body = legacy_encode()
+    msgpack_body, msgpack_properties = codec.encode(MESSAGE, 'msgpack')
+    assert codec.decode(msgpack_body, **msgpack_properties) == legacy_decode(legacy_body)
+
+    measure('json encode', legacy_encode, args)
+    measure('msgpack encode', lambda: codec.encode(MESSAGE, 'msgpack'), args)
+    measure('json decode', lambda: legacy_decode(legacy_body), args)
+    measure('msgpack decode', lambda: codec.decode(msgpack_body, **msgpack_properties), args)
+
+    print()
+    for label, body in (('json', legacy_body), ('msgpack', msgpack_body)):
+        total = len(body) * args.messages / 2 ** 20
+        print(f"{label:<16} {len(body):>4} bytes/message  {total:>8.1f} MiB for {args.messages} queued messages")
+    print(f"{'saving':<16} {1 - len(msgpack_body) / len(legacy_body):>9.0%}")
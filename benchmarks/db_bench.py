@@ -0,0 +1,99 @@
+"""
+Requests/sec of registry lookups under concurrent load, comparing blocking
+pymongo calls made from async handlers with the async data-access layer.
+
+    python benchmarks/db_bench.py --mock --rtt-ms 1 --concurrency 64
+    python benchmarks/db_bench.py --url mongodb://localhost:27017 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from db import Database
+
+DB_NAME = 'bench_database'
+
+class SlowCollection:
+    """
+    Wraps a mongomock collection and sleeps for a fixed round-trip time on
+    every call, standing in for the network hop to a real mongod.
+    """
+
+    def __init__(self, collection, rtt):
+        self.collection = collection
+        self.rtt = rtt
+
+    def find_one(self, *args, **kwargs):
+        time.sleep(self.rtt)
+        return self.collection.find_one(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+def seed(collection, devices):
+    collection.delete_many({})
+    collection.insert_many([
+        {
+            "fonepay": {"merchantId": f"M{i:08d}", "terminalId": f"T{i:08d}"},
+            "machineIdentifier": f"machine-{i}",
+            "enabledServices": ['IPN', 'EMAIL']
+        }
+        for i in range(devices)
+    ])
+
+async def run(label, lookup, requests, concurrency, devices):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            n = i % devices
+            await lookup(f"M{n:08d}", f"T{n:08d}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12} {requests / elapsed:>10.0f} req/s  ({requests} requests, concurrency {concurrency})")
+
+async def main(args):
+    if args.mock:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(args.url)
+
+    seed(client[DB_NAME]['merchant-registry'], args.devices)
+
+    # Blocking driver called directly from the event loop, as main.py used to
+    registry = client[DB_NAME]['merchant-registry']
+    if args.mock:
+        registry = SlowCollection(registry, args.rtt_ms / 1000)
+
+    async def blocking_lookup(merchant_id, terminal_id):
+        registry.find_one({"fonepay.merchantId": merchant_id, "fonepay.terminalId": terminal_id})
+
+    await run('blocking', blocking_lookup, args.requests, args.concurrency, args.devices)
+
+    if args.mock:
+        db = Database(name=DB_NAME, client=client)
+    else:
+        db = Database(url=args.url, name=DB_NAME)
+    await db.connect()
+    if args.mock:
+        db.registry = registry
+    await run('async layer', db.find_device, args.requests, args.concurrency, args.devices)
+    await db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='mongodb://localhost:27017/')
+    parser.add_argument('--mock', action='store_true', help='use mongomock instead of a local mongod')
+    parser.add_argument('--rtt-ms', type=float, default=1.0, help='simulated round trip for --mock')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--devices', type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,54 @@
+"""
+Signature verifications per second on one core: the original string-based
+verification against HmacVerifier on raw bytes.
+
+    python benchmarks/hmac_bench.py --body-size 600 --seconds 2
+"""
+import argparse
+import hmac
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hmac_auth import HmacVerifier, NonceCache, generate_signature
+
+API_KEY = 'bench-key'
+API_SECRET = 'bench-secret'
+
+def legacy_verify(api_key, nonce, signature, body):
+    body_str = body.decode()
+    expected_signature = generate_signature(API_SECRET, nonce, api_key, body_str)
+    return signature == expected_signature
+
+def measure(label, verify, args):
+    count = 0
+    deadline = time.perf_counter() + args.seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            verify()
+        count += 1000
+    rate = count / args.seconds
+    print(f"{label:<16} {rate:>10.0f} verifications/s  ({1e6 / rate:.2f} us each)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--body-size', type=int, default=600, help='approximate request body size in bytes')
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    body = json.dumps({"remark1": "x" * args.body_size}).encode()
+    nonce = str(int(time.time() * 1000))
+    signature = generate_signature(API_SECRET, nonce, API_KEY, body.decode())
+
+    verifier = HmacVerifier({API_KEY: API_SECRET})
+    nonces = NonceCache()
+    assert verifier.verify(API_KEY, nonce, signature, body)
+    counter = iter(range(10 ** 12))
+
+    measure('legacy', lambda: legacy_verify(API_KEY, nonce, signature, body), args)
+    measure('verifier', lambda: verifier.verify(API_KEY, nonce, signature, body), args)
+    measure('verifier+nonce', lambda: verifier.verify(API_KEY, nonce, signature, body)
+            and nonces.use(API_KEY, str(next(counter))), args)
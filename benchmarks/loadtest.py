@@ -0,0 +1,551 @@
+"""
+Load test of the notification pipeline. Fires signed /notification/send and
+/callback traffic at a fixed rate and concurrency against a registry of
+merchants and terminals, then drives the consumers with the same
+notifications against local fake SMTP, SMS (Twilio) and Koili IPN
+endpoints. Reports p50/p99/p999 latency and throughput per endpoint, per
+API stage and per consumer queue.
+
+By default the API runs in-process on mongomock with the broker replaced by
+a recording publisher; pass --db-url to use a local mongod, or --url to load
+an already running deployment (its registry is seeded through --db-url).
+Request and traffic generation is seeded, so runs with the same arguments
+send the same traffic. Save a run with --output and compare a later one
+against it with --compare to catch regressions between commits.
+
+    python benchmarks/loadtest.py --requests 5000 --rate 500 --concurrency 32 --output base.json
+    python benchmarks/loadtest.py --requests 5000 --rate 500 --concurrency 32 --compare base.json
+    python benchmarks/loadtest.py --url http://localhost:8000 --db-url mongodb://localhost:27017 --rate 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import codec
+from dispatcher import route
+from hmac_auth import HmacVerifier, generate_signature
+
+DB_NAME = 'loadtest_database'
+
+# Service mixes of the seeded devices, cycled like mongodb_mockserver.py
+SERVICE_MIXES = (['IPN'], ['EMAIL'], ['IPN', 'EMAIL'], ['IPN', 'EMAIL', 'SMS'])
+
+QUANTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+# Fake providers
+
+async def provider_http(reader, writer, latency):
+    """
+    Stand-in for the Twilio and Koili IPN APIs: answers every request with
+    a success after `latency` seconds, over keep-alive connections.
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            length = 0
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            await asyncio.sleep(latency)
+            if b'/Messages.json' in request_line:
+                status, body = b'201 Created', {"sid": "SM" + uuid.uuid4().hex, "status": "queued"}
+            else:
+                status, body = b'200 OK', {"message": "Success", "responseCode": "000"}
+            payload = json.dumps(body).encode()
+            writer.write(
+                b'HTTP/1.1 ' + status + b'\r\nContent-Type: application/json\r\nContent-Length: '
+                + str(len(payload)).encode() + b'\r\n\r\n' + payload
+            )
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def provider_smtp(reader, writer, latency):
+    """
+    Minimal SMTP server accepting every message after `latency` seconds.
+    No STARTTLS and no AUTH, so the pool must run with SMTP_STARTTLS=false.
+    """
+    try:
+        writer.write(b'220 loadtest ESMTP\r\n')
+        while line := await reader.readline():
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                writer.write(b'250 loadtest\r\n')
+            elif command == b'DATA':
+                writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                await reader.readuntil(b'\r\n.\r\n')
+                await asyncio.sleep(latency)
+                writer.write(b'250 OK\r\n')
+            elif command == b'QUIT':
+                writer.write(b'221 Bye\r\n')
+                await writer.drain()
+                return
+            else:
+                writer.write(b'250 OK\r\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def run_providers(latency, ports):
+    http = await asyncio.start_server(lambda r, w: provider_http(r, w, latency), '127.0.0.1', 0)
+    smtp = await asyncio.start_server(lambda r, w: provider_smtp(r, w, latency), '127.0.0.1', 0)
+    ports.send((http.sockets[0].getsockname()[1], smtp.sockets[0].getsockname()[1]))
+    await asyncio.Event().wait()
+
+def serve_providers(latency, ports):
+    asyncio.run(run_providers(latency, ports))
+
+def start_providers(latency):
+    """
+    Start the fake providers in a separate process, so that they do not
+    compete with the measured code for the CPU, and point the transports at
+    them. Must run before email_sender and koili_ipn are imported, as they
+    read their endpoints at import time.
+    """
+    receiver, ports = multiprocessing.Pipe(duplex=False)
+    multiprocessing.Process(target=serve_providers, args=(latency, ports), daemon=True).start()
+    http_port, smtp_port = receiver.recv()
+
+    base = f"http://127.0.0.1:{http_port}"
+    os.environ.update(
+        TWILIO_API_URL=base,
+        API_ENDPOINT=f"{base}/ipn",
+        SMTP_HOST='127.0.0.1',
+        SMTP_PORT=str(smtp_port),
+        SMTP_STARTTLS='false'
+    )
+    # The provider rate limit would hide the pipeline's own cost; set
+    # SMS_RATE_LIMIT explicitly to include it
+    os.environ.setdefault('SMS_RATE_LIMIT', '0')
+    # The fake SMS provider accepts any credentials
+    os.environ.setdefault('TWILIO_ACCOUNT_SID', 'ACloadtest')
+    os.environ.setdefault('TWILIO_AUTH_TOKEN', 'loadtest')
+    os.environ.setdefault('TWILIO_PHONE_NUMBER', '+15005550006')
+
+# Traffic
+
+def registry_documents(merchants, terminals):
+    return [
+        {
+            "fonepay": {"merchantId": f"M{m:08d}", "terminalId": f"T{m:08d}{t:04d}"},
+            "machineIdentifier": str(uuid.UUID(int=m * terminals + t)),
+            "enabledServices": SERVICE_MIXES[(m * terminals + t) % len(SERVICE_MIXES)]
+        }
+        for m in range(merchants)
+        for t in range(terminals)
+    ]
+
+def seed(database, documents):
+    database['merchant-registry'].delete_many({})
+    database['transaction'].delete_many({})
+    database['merchant-registry'].insert_many([dict(document) for document in documents])
+
+def generate_traffic(args, devices, run_id):
+    """
+    The requests of a run, in sending order: (path, body) pairs plus the
+    queued notifications the send requests produce.
+    """
+    rng = random.Random(args.seed)
+    requests = []
+    notifications = []
+    for i in range(args.requests):
+        device = rng.choice(devices)
+        merchant_id = device['fonepay']['merchantId']
+        terminal_id = device['fonepay']['terminalId']
+        if rng.random() < args.callback_ratio:
+            body = {"merchantId": merchant_id, "terminalId": terminal_id}
+            requests.append(('/callback', json.dumps(body)))
+            continue
+
+        amount = f"{rng.randint(10, 50000)}.0"
+        mobile_number = f"98{rng.randrange(10 ** 8):08d}"
+        email = f"{merchant_id.lower()}@example.com"
+        body = {
+            "mobileNumber": mobile_number,
+            "remark1": "Load test",
+            "retrievalReferenceNumber": f"{i:012d}",
+            "amount": amount,
+            "merchantId": merchant_id,
+            "terminalId": terminal_id,
+            "type": "alert",
+            "uniqueId": f"{run_id}-{i}",
+            "properties": {
+                "txnDate": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "secondaryMobileNumber": mobile_number,
+                "email": email,
+                "sessionSrlNo": str(i),
+                "commission": "0.0",
+                "initiator": mobile_number
+            }
+        }
+        requests.append(('/notification/send', json.dumps(body)))
+        data = {
+            'amount': amount,
+            'mobileNumber': mobile_number,
+            'email': email,
+            'merchantId': merchant_id,
+            'terminalId': terminal_id,
+            'commission': 0.0,
+            'machineIdentifier': device['machineIdentifier'],
+            'enabledServices': device['enabledServices']
+        }
+        for queue_name in route(data, device['enabledServices']):
+            notifications.append((queue_name, f"{run_id}-{i}", data))
+    return requests, notifications
+
+def sign(api_key, api_secret, body):
+    nonce = uuid.uuid4().hex
+    signature = generate_signature(api_secret, nonce, api_key, body)
+    return {"Content-Type": "application/json", "Authorization": f"HmacSHA512 {api_key}:{nonce}:{signature}"}
+
+# Statistics
+
+def summarize(samples, elapsed, errors=0, count=None):
+    """
+    Latency quantiles (nearest rank, in milliseconds) and throughput of a
+    list of samples in seconds.
+    """
+    samples = sorted(samples)
+    count = len(samples) if count is None else count
+    summary = {"count": count, "errors": errors, "throughput": round(count / elapsed, 1) if elapsed else 0.0}
+    for name, q in QUANTILES:
+        summary[name] = round(samples[max(0, math.ceil(q * len(samples)) - 1)] * 1000, 3) if samples else None
+    summary["max"] = round(samples[-1] * 1000, 3) if samples else None
+    return summary
+
+def histogram_summary(child, elapsed, count=None):
+    """
+    Summary of a metrics histogram child. Quantiles are interpolated within
+    the buckets, as Prometheus' histogram_quantile does, so they are only as
+    precise as the bucket bounds.
+    """
+    import metrics
+    counts = list(child.buckets)
+    total = sum(counts)
+    summary = {"count": total if count is None else count, "errors": 0,
+               "throughput": round((total if count is None else count) / elapsed, 1) if elapsed else 0.0}
+    bounds = (0.0,) + child.bounds + (child.bounds[-1],)
+    for name, q in QUANTILES:
+        value = None
+        if total:
+            rank = q * total
+            cumulative = 0
+            for index, bucket_count in enumerate(counts):
+                if cumulative + bucket_count >= rank:
+                    lower, upper = bounds[index], bounds[index + 1]
+                    value = lower + (upper - lower) * (rank - cumulative) / bucket_count
+                    break
+                cumulative += bucket_count
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    summary["mean"] = round(child.sum / total * 1000, 3) if total else None
+    return summary
+
+# API load
+
+async def fire(client, requests, headers, rate, concurrency):
+    """
+    Send the requests from `concurrency` workers. With a rate, request i is
+    due at i / rate seconds and its latency is measured from that time, so a
+    slow server is not hidden by requests queueing up in the client.
+    """
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+    indexes = itertools.count()
+
+    async def worker(started):
+        for i in indexes:
+            if i >= len(requests):
+                return
+            path, body = requests[i]
+            due = started + i / rate if rate else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                response = await client.post(path, content=body, headers=headers[i])
+                failed = response.status_code != 200
+            except httpx.HTTPError:
+                failed = True
+            samples[path].append(time.perf_counter() - due)
+            errors[path] += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(started) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "api" + path.replace('/notification', ''): summarize(path_samples, elapsed, errors[path])
+        for path, path_samples in samples.items()
+    }, elapsed
+
+class RecordingPublisher:
+    """
+    Publisher that keeps the messages instead of sending them to a broker.
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def declare(self, queue_names):
+        pass
+
+    async def publish_many(self, messages):
+        self.published += len(messages)
+        return [None] * len(messages)
+
+    async def publish_batch(self, messages, **kwargs):
+        self.published += len(messages)
+
+async def load_in_process(args, documents, requests, headers):
+    if args.db_url:
+        os.environ['DB_URL'] = args.db_url
+    os.environ['DB_NAME'] = DB_NAME
+    # Generated traffic reuses terminals far faster than real ones do; set
+    # the rate limits explicitly to include them
+    os.environ.setdefault('TERMINAL_RATE_LIMIT', '0')
+    os.environ.setdefault('MOBILE_RATE_LIMIT', '0')
+    import metrics
+    import main
+    import transaction_writer
+    from outbox import RELAYED
+
+    main.hmac_verifier = HmacVerifier(keys={args.api_key: args.api_secret})
+
+    if args.db_url:
+        from pymongo import MongoClient
+        seed(MongoClient(args.db_url)[DB_NAME], documents)
+    else:
+        import mongomock
+        main.db.client = mongomock.MongoClient()
+        seed(main.db.client[DB_NAME], documents)
+    publisher = RecordingPublisher()
+    main.dispatcher.publisher = publisher
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest') as client:
+            results, elapsed = await fire(client, requests, headers, args.rate, args.concurrency)
+    # Leaving the lifespan flushed the writer and the outbox
+
+    counts = {
+        'insert': transaction_writer.PERSISTED.labels('success').value,
+        'publish': RELAYED.labels('success').value
+    }
+    for (stage,), child in metrics.STAGE_LATENCY.children.items():
+        results[f"stage.{stage}"] = histogram_summary(child, elapsed, counts.get(stage))
+    results["stage.publish"]["queued"] = publisher.published
+    return results
+
+async def load_remote(args, documents, requests, headers):
+    if args.db_url:
+        from pymongo import MongoClient
+        seed(MongoClient(args.db_url)[os.getenv('DB_NAME', DB_NAME)], documents)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+        results, _ = await fire(client, requests, headers, args.rate, args.concurrency)
+    return results
+
+# Consumers
+
+class QueuedMessage:
+    """
+    The attributes of an incoming broker message that the consumers read.
+    """
+
+    def __init__(self, message_id, body, properties):
+        self.message_id = message_id
+        self.body = body
+        self.content_type = properties['content_type']
+        self.headers = properties['headers']
+
+async def drain_queue(queue_name, messages, send_batch, batch_size, concurrency):
+    import sender
+    batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)]
+    samples = []
+    errors = 0
+    pending = iter(batches)
+
+    async def worker():
+        nonlocal errors
+        for batch in pending:
+            started = time.perf_counter()
+            outcomes = await sender.process_messages(queue_name, batch, send_batch)
+            samples.append(time.perf_counter() - started)
+            errors += sum(1 for _, outcome in outcomes if not outcome)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    summary = summarize(samples, time.perf_counter() - started, errors, count=len(messages))
+    summary["batches"] = len(batches)
+    return summary
+
+async def run_consumers(args, notifications):
+    """
+    Send the notifications through the consumers' batch path and real
+    transports, with the queues drained concurrently as in sender.Runtime.
+    Latencies are per batch; throughput is messages per second.
+    """
+    import sender
+    from email_sender import email_alerts, sms_alerts
+    from koili_ipn import IPNClient
+
+    queued = defaultdict(list)
+    for queue_name, message_id, data in notifications:
+        body, properties = codec.encode(data)
+        queued[queue_name].append(QueuedMessage(message_id, body, properties))
+
+    ipn_client = IPNClient()
+    transports = {
+        'koili_ipn_queue': ipn_client.send_many,
+        'email_queue': sender.blocking(email_alerts),
+        'sms_queue': sender.blocking(sms_alerts)
+    }
+    queue_names = list(queued)
+    try:
+        summaries = await asyncio.gather(*[
+            drain_queue(
+                queue_name, queued[queue_name], transports[queue_name], sender.BATCH_SIZE,
+                args.consumer_concurrency or sender.queue_concurrency(queue_name)
+            )
+            for queue_name in queue_names
+        ])
+    finally:
+        await ipn_client.close()
+    return {f"consumer.{queue_name}": summary for queue_name, summary in zip(queue_names, summaries)}
+
+# Reporting
+
+def git_revision():
+    root = os.path.join(os.path.dirname(__file__), '..')
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def print_results(results):
+    print(f"{'':<26}{'count':>8}{'errors':>8}{'msg/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+    for name, summary in results.items():
+        cells = [f"{summary[q]:10.3f}" if summary[q] is not None else f"{'-':>10}" for q in ('p50', 'p99', 'p999')]
+        print(f"{name:<26}{summary['count']:>8}{summary['errors']:>8}{summary['throughput']:>10.1f}" + ''.join(cells))
+
+def compare(report, baseline, tolerance):
+    """
+    Print the change of each result against a saved run. Returns the names
+    of the results whose p99 grew, or whose throughput fell, by more than
+    `tolerance`.
+    """
+    if report['config'] != baseline.get('config'):
+        print("warning: the baseline was run with different arguments")
+    print(f"\nagainst {(baseline.get('commit') or 'unknown')[:12]}:")
+    regressions = []
+    for name, summary in report['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        changes = []
+        regressed = False
+        for key, worse in (('p99', 1), ('throughput', -1)):
+            if not before.get(key) or summary.get(key) is None:
+                continue
+            change = (summary[key] - before[key]) / before[key]
+            changes.append(f"{key} {before[key]:.3f} -> {summary[key]:.3f} ({change:+.1%})")
+            regressed = regressed or change * worse > tolerance
+        if summary['errors'] > before.get('errors', 0):
+            changes.append(f"errors {before.get('errors', 0)} -> {summary['errors']}")
+            regressed = True
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<26}{'  '.join(changes)}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+async def main(args):
+    # Configure logging before the modules do, to keep per-message logging
+    # out of the measurement
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+    start_providers(args.provider_latency_ms / 1000)
+
+    documents = registry_documents(args.merchants, args.terminals)
+    run_id = args.run_id or (uuid.uuid4().hex[:8] if args.url else 'loadtest')
+    requests, notifications = generate_traffic(args, documents, run_id)
+    headers = [sign(args.api_key, args.api_secret, body) for _, body in requests]
+
+    if args.url:
+        results = await load_remote(args, documents, requests, headers)
+    else:
+        results = await load_in_process(args, documents, requests, headers)
+    results.update(await run_consumers(args, notifications))
+
+    commit, dirty = git_revision()
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'tolerance', 'api_secret', 'run_id')}
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "config": config,
+        "results": results
+    }
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='load a running API instead of an in-process one')
+    parser.add_argument('--db-url', help='MongoDB to seed (and, in-process, to use) instead of mongomock')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=0, help='requests per second (0 sends as fast as possible)')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight')
+    parser.add_argument('--callback-ratio', type=float, default=0.2, help='share of /callback requests')
+    parser.add_argument('--merchants', type=int, default=200)
+    parser.add_argument('--terminals', type=int, default=5, help='terminals per merchant')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the traffic generator')
+    parser.add_argument('--run-id', help='prefix of the uniqueIds sent (random with --url, so reruns are not duplicates)')
+    parser.add_argument('--provider-latency-ms', type=float, default=20, help='response time of the fake providers')
+    parser.add_argument('--consumer-concurrency', type=int, default=0, help='batches in flight per queue (default: as sender.py)')
+    parser.add_argument('--api-key', default=os.getenv('API_KEY', 'loadtest'))
+    parser.add_argument('--api-secret', default=os.getenv('API_SECRET', 'loadtest-secret'))
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against the JSON results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change reported as a regression')
+    asyncio.run(main(parser.parse_args()))
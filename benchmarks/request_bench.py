@@ -0,0 +1,155 @@
+"""
+Request parsing cost per /notification/send payload on one core: the
+original path (FastAPI-style json.loads, v1 validators, request.dict() and
+json.dumps of the queue message) against the single-parse path
+(model_validate_json, one model_dump and pydantic_core.to_json).
+
+The legacy email check is run without its DNS deliverability lookup, so
+its figure understates what the old path cost in production.
+
+    python benchmarks/request_bench.py --seconds 2
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+from datetime import datetime
+from typing import Optional
+
+import email_validator
+from pydantic import BaseModel, Field, validator
+from pydantic_core import to_json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from main import SendNotificationRequest
+
+email_validator.CHECK_DELIVERABILITY = False
+
+PAYLOAD = json.dumps({
+    "mobileNumber": "9849669934",
+    "remark1": "Message to send",
+    "retrievalReferenceNumber": "70112545",
+    "amount": "40.0",
+    "merchantId": "M1",
+    "terminalId": "T1",
+    "type": "otp",
+    "uniqueId": "202307201141001",
+    "properties": {
+        "txnDate": "2023-07-22 01:00:10",
+        "secondaryMobileNumber": "9012932645",
+        "email": "pokharelsamir246@gmail.com",
+        "sessionSrlNo": "69",
+        "commission": "0.0",
+        "initiator": "98xxxxxxxx"
+    }
+}).encode()
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+
+    class LegacyProperties(BaseModel):
+        commission: Optional[float] = None
+        sessionSrlNo: Optional[str] = None
+        txnDate: Optional[datetime] = None
+        secondaryMobileNumber: Optional[str] = None
+        email: Optional[str] = None
+        initiator: Optional[str] = None
+
+        @validator('secondaryMobileNumber')
+        def validate_secondary_mobile_number(cls, v):
+            if v and (not v.isdigit() or len(v) != 10):
+                raise ValueError('Payload Invalid')
+            return v
+
+        @validator('txnDate', pre=True)
+        def parse_datetime(cls, v):
+            if isinstance(v, str):
+                return datetime.strptime(v, "%Y-%m-%d %H:%M:%S")
+            return v
+
+        @validator('email')
+        def validate_email(cls, v):
+            if v:
+                email_validator.validate_email(v, check_deliverability=False)
+            return v
+
+    class LegacyRequest(BaseModel):
+        mobileNumber: str = Field(..., pattern=r'^\d{10}$')
+        merchantId: str
+        terminalId: str
+        retrievalReferenceNumber: str
+        amount: str
+        remark1: str
+        type: Optional[str] = None
+        uniqueId: str
+        properties: Optional[LegacyProperties] = None
+
+        @validator('amount')
+        def validate_amount(cls, v):
+            if not v.replace('.', '').isdigit():
+                raise ValueError('Payload Invalid')
+            return v
+
+        @validator('type')
+        def validate_type(cls, v):
+            if v and v not in ['alert', 'otp']:
+                raise ValueError('Payload Invalid')
+            return v
+
+        @validator('mobileNumber')
+        def validate_mobile_number(cls, v):
+            if not v.isdigit() or len(v) != 10:
+                raise ValueError('Payload Invalid')
+            return v
+
+def message(request, properties):
+    return {
+        'amount': request.amount,
+        'mobileNumber': request.mobileNumber,
+        'email': properties.get('email'),
+        'merchantId': request.merchantId,
+        'terminalId': request.terminalId,
+        'commission': properties.get('commission'),
+        'machineIdentifier': 'mid',
+        'enabledServices': ['IPN', 'EMAIL', 'SMS']
+    }
+
+def legacy(body):
+    # The HMAC dependency decoded the body, then FastAPI parsed it again
+    body.decode()
+    request = LegacyRequest(**json.loads(body))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        transaction = request.dict()
+    transaction['timestamp'] = datetime.now()
+    properties = request.properties.__dict__ if request.properties else {}
+    return json.dumps(message(request, properties)).encode()
+
+def single_parse(body):
+    request = SendNotificationRequest.model_validate_json(body)
+    transaction = request.model_dump()
+    transaction = dict(transaction, timestamp=datetime.now())
+    return to_json(message(request, transaction['properties'] or {}))
+
+def measure(label, parse, args):
+    count = 0
+    deadline = time.perf_counter() + args.seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            parse(PAYLOAD)
+        count += 1000
+    rate = count / args.seconds
+    print(f"{label:<14} {rate:>10.0f} requests/s  ({1e6 / rate:.2f} us each)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    assert json.loads(legacy(PAYLOAD)) == json.loads(single_parse(PAYLOAD))
+
+    measure('legacy', legacy, args)
+    measure('single-parse', single_parse, args)
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import metrics
+from metrics import PROVIDER_CALLS, PROVIDER_LATENCY, PROVIDER_SHED
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Defaults for every outbound destination
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+LIMITER_LATENCY_TARGET = float(os.getenv('LIMITER_LATENCY_TARGET', 2.0))
+LIMITER_BACKOFF = float(os.getenv('LIMITER_BACKOFF', 0.5))
+LIMITER_MAX_WAIT = float(os.getenv('LIMITER_MAX_WAIT', 10))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class Unavailable(Exception):
+    """
+    Raised instead of calling a destination that is shedding load.
+    """
+
+class CircuitOpenError(Unavailable):
+    pass
+
+class ConcurrencyLimitError(Unavailable):
+    pass
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    until `reset_timeout` has passed. It then lets a single trial call
+    through (half-open) and closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.trial = False
+            if self.state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def cancel(self):
+        """
+        Give back a half-open trial slot that was not used.
+        """
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.trial = False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.state = CLOSED
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit. Each call that succeeds within the latency
+    target grows the limit by about one per limit's worth of calls; a
+    failure or a slow call multiplies it by `backoff`, at most once per
+    latency target so that one slow burst only counts once.
+
+    The limit is the admission gate: callers beyond it wait for a slot,
+    from a thread with acquire() or from the event loop with
+    acquire_async(), for up to `max_wait` seconds.
+    """
+
+    def __init__(self, max_limit, min_limit=1, latency_target=LIMITER_LATENCY_TARGET, backoff=LIMITER_BACKOFF,
+                 max_wait=LIMITER_MAX_WAIT):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.limit = float(max_limit)
+        self.inflight = 0
+        self.decreased_at = 0.0
+        self.lock = threading.Lock()
+        # Callbacks that wake a waiting caller, oldest first
+        self.waiters = deque()
+
+    def acquire(self, timeout=None):
+        """
+        Take a slot, waiting up to `timeout` seconds (default `max_wait`).
+        Returns False when none freed up in time.
+        """
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        while True:
+            woken = threading.Event()
+            if self._take_or_wait(woken.set):
+                return True
+            woken.wait(max(0, deadline - time.monotonic()))
+            if time.monotonic() >= deadline:
+                return self._give_up(woken.set)
+
+    async def acquire_async(self, timeout=None):
+        """
+        acquire() for callers on an event loop.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.max_wait if timeout is None else timeout)
+        while True:
+            woken = loop.create_future()
+
+            def wake(woken=woken):
+                loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+            if self._take_or_wait(wake):
+                return True
+            try:
+                await asyncio.wait_for(woken, max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                return self._give_up(wake)
+
+    def _take_or_wait(self, wake):
+        with self.lock:
+            if self.inflight < int(self.limit):
+                self.inflight += 1
+                return True
+            self.waiters.append(wake)
+            return False
+
+    def _give_up(self, wake):
+        """
+        Last attempt once the wait has timed out.
+        """
+        with self.lock:
+            try:
+                self.waiters.remove(wake)
+                woken = False
+            except ValueError:
+                woken = True
+            if self.inflight < int(self.limit):
+                self.inflight += 1
+                return True
+            if woken:
+                # Pass on the wake-up this caller received but cannot use
+                self._wake()
+            return False
+
+    def _wake(self):
+        # Called with the lock held; woken callers compete for the slots again
+        for _ in range(int(self.limit) - self.inflight):
+            if not self.waiters:
+                break
+            self.waiters.popleft()()
+
+    def release(self, latency, success):
+        with self.lock:
+            self.inflight -= 1
+            if success and latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                now = time.monotonic()
+                if now - self.decreased_at >= self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.decreased_at = now
+            self._wake()
+
+class Destination:
+    """
+    Circuit breaker and adaptive concurrency limit for one outbound
+    provider. Calls beyond the current limit wait for a slot; they are
+    rejected with `Unavailable` while the circuit is open or when no slot
+    frees up within the limiter's `max_wait`, so consumers defer the work
+    to the retry queues instead of blocking on an unhealthy destination.
+    """
+
+    def __init__(self, name, max_concurrency, latency_target=None,
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        if latency_target is None:
+            latency_target = float(os.getenv(f'{name.upper()}_LATENCY_TARGET', LIMITER_LATENCY_TARGET))
+        self.name = name
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.limiter = AdaptiveLimiter(max_concurrency, latency_target=latency_target)
+        self.calls = 0
+        self.failures = 0
+        self.shed = 0
+        self.latency = PROVIDER_LATENCY.labels(name)
+        self.successes_metric = PROVIDER_CALLS.labels(name, 'success')
+        self.failures_metric = PROVIDER_CALLS.labels(name, 'failure')
+        self.shed_metric = PROVIDER_SHED.labels(name)
+        destinations[name] = self
+
+    def _shed(self, error):
+        self.shed += 1
+        self.shed_metric.inc()
+        raise error
+
+    def acquire(self, timeout=None):
+        """
+        Reserve a call slot, waiting for one if the destination is at its
+        limit. Returns a token to pass to release().
+        """
+        if not self.breaker.allow():
+            self._shed(CircuitOpenError(f"{self.name} circuit is open"))
+        if not self.limiter.acquire(timeout):
+            self.breaker.cancel()
+            self._shed(ConcurrencyLimitError(f"{self.name} had no free call slot in time"))
+        return time.monotonic()
+
+    async def acquire_async(self, timeout=None):
+        """
+        acquire() for callers on an event loop.
+        """
+        if not self.breaker.allow():
+            self._shed(CircuitOpenError(f"{self.name} circuit is open"))
+        if not await self.limiter.acquire_async(timeout):
+            self.breaker.cancel()
+            self._shed(ConcurrencyLimitError(f"{self.name} had no free call slot in time"))
+        return time.monotonic()
+
+    def release(self, started, success):
+        latency = time.monotonic() - started
+        self.calls += 1
+        self.latency.observe(latency)
+        if success:
+            self.successes_metric.inc()
+        else:
+            self.failures += 1
+            self.failures_metric.inc()
+        self.limiter.release(latency, success)
+        before = self.breaker.state
+        self.breaker.record(success)
+        if self.breaker.state != before:
+            logger.warning("Circuit for %s is now %s", self.name, self.breaker.state)
+
+    @contextmanager
+    def call(self, is_failure=lambda e: True):
+        """
+        Guard a block of code; exceptions for which `is_failure` is true
+        count against the destination's health.
+        """
+        started = self.acquire()
+        success = True
+        try:
+            yield
+        except Exception as e:
+            success = not is_failure(e)
+            raise
+        finally:
+            self.release(started, success)
+
+    def snapshot(self):
+        return {
+            'state': self.breaker.state,
+            'limit': int(self.limiter.limit),
+            'inflight': self.limiter.inflight,
+            'waiting': len(self.limiter.waiters),
+            'calls': self.calls,
+            'failures': self.failures,
+            'shed': self.shed
+        }
+
+# All destinations by name, for metrics
+destinations = {}
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+metrics.Gauge(
+    'provider_circuit_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)', ('provider',),
+    collect=lambda: {(name,): STATE_VALUES[destination.breaker.state] for name, destination in destinations.items()}
+)
+metrics.Gauge(
+    'provider_concurrency_limit', 'Current adaptive concurrency limit', ('provider',),
+    collect=lambda: {(name,): int(destination.limiter.limit) for name, destination in destinations.items()}
+)
+metrics.Gauge(
+    'provider_inflight', 'Calls in flight', ('provider',),
+    collect=lambda: {(name,): destination.limiter.inflight for name, destination in destinations.items()}
+)
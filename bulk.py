@@ -0,0 +1,139 @@
+import codecs
+import json
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Bulk ingestion limits
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', 100000))
+BULK_MAX_ITEM_BYTES = int(os.getenv('BULK_MAX_ITEM_BYTES', 16384))
+# Items are held until the signature at the end of the body checks out,
+# so the body size bounds what an unverified caller can make us hold
+BULK_MAX_BYTES = int(os.getenv('BULK_MAX_BYTES', 64 * 1024 * 1024))
+# Items validated, looked up and inserted together
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 1000))
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class BulkFormatError(ValueError):
+    pass
+
+class BulkTooLargeError(BulkFormatError):
+    pass
+
+class BulkParser:
+    """
+    Incremental splitter for a bulk request body: either NDJSON (one JSON
+    object per line) or a JSON array of objects, told apart by the first
+    non-blank byte. feed() takes the body a chunk at a time and returns the
+    JSON text of the items it completed, so the body is never held or
+    parsed as a whole; the items are validated by the caller.
+
+    A malformed NDJSON line is just an invalid item. Broken array framing
+    (or an item over `max_item_bytes`) cannot be recovered from and raises
+    BulkFormatError; more than `max_items` items raise BulkTooLargeError.
+    """
+
+    def __init__(self, max_items=BULK_MAX_ITEMS, max_item_bytes=BULK_MAX_ITEM_BYTES):
+        self.max_items = max_items
+        self.max_item_bytes = max_item_bytes
+        self.count = 0
+        self.array = None
+        self.buffer = b''
+        # Array mode: decoded text not yet consumed, and what comes next
+        # (open, first, value, separator or end)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.expect = 'open'
+
+    def feed(self, chunk):
+        return self._counted(self._feed(chunk))
+
+    def close(self):
+        """
+        Return the items left at the end of the body.
+        """
+        return self._counted(self._close())
+
+    def _counted(self, items):
+        self.count += len(items)
+        if self.count > self.max_items:
+            raise BulkTooLargeError(f"More than {self.max_items} items")
+        return items
+
+    def _feed(self, chunk):
+        if self.array is None:
+            self.buffer += chunk
+            start = self.buffer.lstrip()
+            if not start:
+                return []
+            self.array = start[:1] == b'['
+            chunk, self.buffer = self.buffer, b''
+        if self.array:
+            return self._feed_array(chunk, final=False)
+        return self._feed_lines(chunk)
+
+    def _close(self):
+        if self.array:
+            items = self._feed_array(b'', final=True)
+            if self.expect != 'end':
+                raise BulkFormatError("Unterminated JSON array")
+            return items
+        if self.array is None:
+            return []
+        items = [self.buffer] if self.buffer.strip() else []
+        self.buffer = b''
+        return items
+
+    def _feed_lines(self, chunk):
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+        if max(map(len, lines + [self.buffer])) > self.max_item_bytes:
+            raise BulkFormatError(f"Item larger than {self.max_item_bytes} bytes")
+        return [line for line in lines if line.strip()]
+
+    def _feed_array(self, chunk, final):
+        try:
+            self.text += self.decoder.decode(chunk, final)
+        except UnicodeDecodeError as e:
+            raise BulkFormatError(str(e))
+        items = []
+        decoder = json.JSONDecoder()
+        text = self.text
+        pos = 0
+        while True:
+            pos = WHITESPACE.match(text, pos).end()
+            if pos == len(text):
+                break
+            char = text[pos]
+            if self.expect == 'open':
+                if char != '[':
+                    raise BulkFormatError("Expected a JSON array")
+                pos += 1
+                self.expect = 'first'
+            elif self.expect in ('first', 'value'):
+                if char == ']' and self.expect == 'first':
+                    pos += 1
+                    self.expect = 'end'
+                    continue
+                try:
+                    _, end = decoder.raw_decode(text, pos)
+                except json.JSONDecodeError:
+                    # Most likely an item cut by the chunk boundary
+                    if final or len(text) - pos > self.max_item_bytes:
+                        raise BulkFormatError("Invalid JSON array item")
+                    break
+                items.append(text[pos:end])
+                pos = end
+                self.expect = 'separator'
+            elif self.expect == 'separator':
+                if char not in ',]':
+                    raise BulkFormatError("Expected ',' or ']' between array items")
+                pos += 1
+                self.expect = 'value' if char == ',' else 'end'
+            else:
+                raise BulkFormatError("Data after the end of the JSON array")
+        self.text = text[pos:]
+        return items
@@ -0,0 +1,68 @@
+import json
+import os
+import msgpack
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Wire format for new queue messages: msgpack (default) or json. Consumers
+# decode both, so they can be upgraded before the API switches format.
+MESSAGE_FORMAT = os.getenv('MESSAGE_FORMAT', 'msgpack')
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+SCHEMA_HEADER = 'x-schema-version'
+
+# Version 1 is the original JSON object. From version 2 a message is a
+# msgpack array holding the fields below by position. Fields are only ever
+# appended, so a consumer reads the fields it knows from any newer version.
+SCHEMA_VERSION = 2
+FIELDS = (
+    'amount',
+    'mobileNumber',
+    'email',
+    'merchantId',
+    'terminalId',
+    'commission',
+    'machineIdentifier',
+    'enabledServices'
+)
+
+def encode(data, message_format=None):
+    """
+    Encode a notification for the queues. Returns the body and the message
+    properties (content type and schema version header) to publish it with.
+    """
+    if (message_format or MESSAGE_FORMAT) == 'json':
+        body = json.dumps(data, separators=(',', ':')).encode()
+        return body, {'content_type': JSON_CONTENT_TYPE, 'headers': {SCHEMA_HEADER: 1}}
+    body = msgpack.packb([data.get(field) for field in FIELDS])
+    return body, {'content_type': MSGPACK_CONTENT_TYPE, 'headers': {SCHEMA_HEADER: SCHEMA_VERSION}}
+
+def decode(body, content_type=None, headers=None):
+    """
+    Decode a queued notification into a dict. Messages without a content
+    type are the original JSON format. Raises ValueError when the body
+    cannot be decoded.
+    """
+    if content_type is None or content_type == JSON_CONTENT_TYPE:
+        return json.loads(body)
+    if content_type != MSGPACK_CONTENT_TYPE:
+        raise ValueError(f"Unsupported content type {content_type}")
+
+    version = (headers or {}).get(SCHEMA_HEADER, SCHEMA_VERSION)
+    try:
+        values = msgpack.unpackb(body)
+    except Exception as e:
+        raise ValueError(f"Invalid msgpack message: {e}")
+    if version < 2 or not isinstance(values, list):
+        raise ValueError(f"Invalid message for schema version {version}")
+    return dict(zip(FIELDS, values))
+
+def decode_message(body, properties):
+    """
+    Decode a message using its pika or aio-pika properties.
+    """
+    if properties is None:
+        return decode(body)
+    return decode(body, properties.content_type, properties.headers)
@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from dotenv import load_dotenv
+from pymongo import MongoClient, ReturnDocument
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# MongoDB Configuration
+DB_URL = os.getenv('DB_URL')
+DB_NAME = os.getenv('DB_NAME')
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 16))
+
+# Fields of a registry document the API actually reads
+DEVICE_PROJECTION = {"fonepay": 1, "machineIdentifier": 1, "enabledServices": 1}
+
+class Database:
+    """
+    Async data-access layer shared by the API endpoints. Uses motor when it
+    is installed, otherwise runs the synchronous pymongo driver on a bounded
+    thread pool so that database round trips never block the event loop.
+    A pymongo-compatible client (e.g. mongomock) can be passed in directly.
+    """
+
+    def __init__(self, url=DB_URL, name=DB_NAME, client=None):
+        self.url = url
+        self.name = name
+        self.client = client
+        self.executor = None
+
+    async def connect(self):
+        if self.client is None:
+            if AsyncIOMotorClient is not None:
+                self.client = AsyncIOMotorClient(self.url)
+            else:
+                self.client = MongoClient(self.url)
+        if not self.is_async:
+            self.executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+        db = self.client[self.name]
+        self.registry = db['merchant-registry']
+        self.registry_meta = db['registry-meta']
+        self.idempotency = db['idempotency']
+        self.transactions = db['transaction']
+        self.workers = db['workers']
+        self.rate_limits = db['rate-limits']
+        logger.info("Connected to MongoDB database %s (async driver: %s)", self.name, self.is_async)
+
+    async def close(self):
+        if self.client is not None:
+            self.client.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.client = None
+        self.executor = None
+
+    @property
+    def is_async(self):
+        return AsyncIOMotorClient is not None and isinstance(self.client, AsyncIOMotorClient)
+
+    async def _run(self, fn, *args, **kwargs):
+        if self.is_async:
+            return await fn(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def _find(self, collection, query, projection=None, sort=None, limit=0):
+        cursor = collection.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        if self.is_async:
+            return await cursor.to_list(length=limit or None)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, list, cursor)
+
+    async def ensure_indexes(self):
+        """
+        Create the indexes the endpoints depend on. A no-op when they
+        already exist.
+        """
+        # _id breaks timestamp ties for keyset pagination of the history
+        await self._run(
+            self.transactions.create_index,
+            [("merchantId", 1), ("terminalId", 1), ("timestamp", -1), ("_id", -1)]
+        )
+        await self._run(
+            self.registry.create_index,
+            [("fonepay.merchantId", 1), ("fonepay.terminalId", 1)]
+        )
+        # Outbox: only transactions with a dispatch still to publish are indexed
+        await self._run(self.transactions.create_index, "dispatch.status", sparse=True)
+        await self._run(self.transactions.create_index, "dispatch.claim", sparse=True)
+
+    async def find_device(self, merchant_id, terminal_id):
+        return await self._run(self.registry.find_one, {
+            "fonepay.merchantId": merchant_id,
+            "fonepay.terminalId": terminal_id
+        }, DEVICE_PROJECTION)
+
+    async def find_devices(self, keys):
+        """
+        Registry documents of many (merchantId, terminalId) pairs with a
+        single query, keyed by pair.
+        """
+        documents = await self._find(self.registry, {"$or": [
+            {"fonepay.merchantId": merchant_id, "fonepay.terminalId": terminal_id}
+            for merchant_id, terminal_id in keys
+        ]}, DEVICE_PROJECTION)
+        return {
+            (document['fonepay']['merchantId'], document['fonepay']['terminalId']): document
+            for document in documents
+        }
+
+    async def find_merchant(self, merchant_id):
+        return await self._run(self.registry.find_one, {"fonepay.merchantId": merchant_id}, {"_id": 1})
+
+    def watch_registry(self):
+        """
+        Open a change stream on the registry collection. Only available with
+        the async driver against a replica set.
+        """
+        if not self.is_async:
+            raise RuntimeError("Registry change streams require the motor driver")
+        return self.registry.watch()
+
+    async def registry_version(self):
+        """
+        Version stamp of the registry, bumped by whatever process updates
+        merchant-registry.
+        """
+        meta = await self._run(self.registry_meta.find_one, {"_id": "merchant-registry"})
+        return meta.get('version') if meta else None
+
+    async def ensure_idempotency_index(self, ttl):
+        await self._run(self.idempotency.create_index, "createdAt", expireAfterSeconds=ttl)
+
+    async def insert_idempotency_key(self, document):
+        return await self._run(self.idempotency.insert_one, document)
+
+    async def find_idempotency_key(self, key):
+        return await self._run(self.idempotency.find_one, {"_id": key})
+
+    async def delete_idempotency_key(self, key):
+        return await self._run(self.idempotency.delete_one, {"_id": key})
+
+    async def insert_idempotency_keys(self, documents):
+        return await self._run(self.idempotency.insert_many, documents, ordered=False)
+
+    async def find_idempotency_keys(self, keys):
+        documents = await self._find(self.idempotency, {"_id": {"$in": keys}})
+        return {document['_id']: document for document in documents}
+
+    async def delete_idempotency_keys(self, keys):
+        return await self._run(self.idempotency.delete_many, {"_id": {"$in": keys}})
+
+    async def ensure_rate_limit_index(self):
+        await self._run(self.rate_limits.create_index, "expiresAt", expireAfterSeconds=0)
+
+    async def take_tokens(self, bucket, rate, capacity, count):
+        """
+        Refill a token bucket up to now (by the database clock) and take up
+        to `count` tokens from it, atomically. Returns the tokens granted
+        and left.
+        """
+        elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updatedAt", "$$NOW"]}]}, 1000]}
+        document = await self._run(
+            self.rate_limits.find_one_and_update,
+            {"_id": bucket},
+            [
+                {"$set": {"tokens": {"$min": [
+                    capacity,
+                    {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}]}
+                ]}}},
+                {"$set": {"granted": {"$min": [count, {"$max": [0, {"$floor": "$tokens"}]}]}}},
+                {"$set": {"tokens": {"$subtract": ["$tokens", "$granted"]}, "updatedAt": "$$NOW"}},
+                # Gone once it would be full again
+                {"$set": {"expiresAt": {"$add": [
+                    "$$NOW", {"$multiply": [{"$subtract": [capacity, "$tokens"]}, 1000 / rate]}
+                ]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return document['granted'], document['tokens']
+
+    async def refund_tokens(self, bucket, capacity, count):
+        return await self._run(
+            self.rate_limits.update_one,
+            {"_id": bucket},
+            [{"$set": {"tokens": {"$min": [capacity, {"$add": ["$tokens", count]}]}}}]
+        )
+
+    async def heartbeat_worker(self, worker_id, heartbeat, **info):
+        return await self._run(
+            self.workers.update_one,
+            {"_id": worker_id},
+            {"$set": dict(info, heartbeat=heartbeat)},
+            upsert=True
+        )
+
+    async def live_workers(self, since):
+        """
+        Ids of the workers whose last heartbeat is not older than `since`.
+        """
+        workers = await self._find(self.workers, {"heartbeat": {"$gte": since}}, {"_id": 1})
+        return sorted(worker["_id"] for worker in workers)
+
+    async def remove_worker(self, worker_id):
+        return await self._run(self.workers.delete_one, {"_id": worker_id})
+
+    async def insert_transactions(self, transactions):
+        return await self._run(self.transactions.insert_many, transactions, ordered=False)
+
+    async def claim_dispatches(self, token, limit, now, expired_before):
+        """
+        Claim up to `limit` transactions whose dispatch is pending (or whose
+        earlier claim was taken before `expired_before` and never settled)
+        and return their _id and dispatch record.
+        """
+        claimable = {"$or": [
+            {"dispatch.status": "pending"},
+            {"dispatch.status": "publishing", "dispatch.claimedAt": {"$lt": expired_before}}
+        ]}
+        candidates = await self._find(self.transactions, claimable, {"_id": 1}, sort=[("_id", 1)], limit=limit)
+        if not candidates:
+            return []
+        await self._run(
+            self.transactions.update_many,
+            {"_id": {"$in": [candidate["_id"] for candidate in candidates]}, **claimable},
+            {"$set": {"dispatch.status": "publishing", "dispatch.claim": token, "dispatch.claimedAt": now}}
+        )
+        return await self._find(self.transactions, {"dispatch.claim": token}, {"dispatch": 1})
+
+    async def mark_dispatched(self, ids, now):
+        return await self._run(
+            self.transactions.update_many,
+            {"_id": {"$in": ids}},
+            {"$set": {"dispatch.sentAt": now},
+             "$unset": {"dispatch.status": "", "dispatch.claim": "", "dispatch.claimedAt": ""}}
+        )
+
+    async def release_dispatches(self, ids):
+        return await self._run(
+            self.transactions.update_many,
+            {"_id": {"$in": ids}},
+            {"$set": {"dispatch.status": "pending"},
+             "$unset": {"dispatch.claim": "", "dispatch.claimedAt": ""}}
+        )
+
+    async def recent_transactions(self, merchant_id, terminal_id, limit=5, projection=None):
+        return await self._find(
+            self.transactions,
+            {"merchantId": merchant_id, "terminalId": terminal_id},
+            projection=projection,
+            sort=[("timestamp", -1)],
+            limit=limit
+        )
+
+    async def stream_transactions(self, merchant_id, terminal_id, after=None, txn_from=None, txn_to=None,
+                                  limit=0, projection=None, batch_size=500):
+        """
+        Transactions of a terminal, newest first, read from one server-side
+        cursor and yielded in batches of up to `batch_size` documents.
+        Pages are keyset-paginated on (timestamp, _id): `after` is the key
+        of the last document of the previous page. `txn_from` (inclusive)
+        and `txn_to` (exclusive) filter on properties.txnDate.
+        """
+        query = {"merchantId": merchant_id, "terminalId": terminal_id}
+        if after is not None:
+            timestamp, last_id = after
+            # The plain range bounds the index scan; the $or breaks ties
+            query["timestamp"] = {"$lte": timestamp}
+            query["$or"] = [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, "_id": {"$lt": last_id}}]
+        txn_date = {}
+        if txn_from is not None:
+            txn_date["$gte"] = txn_from
+        if txn_to is not None:
+            txn_date["$lt"] = txn_to
+        if txn_date:
+            query["properties.txnDate"] = txn_date
+
+        cursor = self.transactions.find(query, projection).sort([("timestamp", -1), ("_id", -1)]).batch_size(batch_size)
+        if limit:
+            cursor = cursor.limit(limit)
+        try:
+            if self.is_async:
+                while batch := await cursor.to_list(length=batch_size):
+                    yield batch
+            else:
+                loop = asyncio.get_running_loop()
+                while batch := await loop.run_in_executor(self.executor, lambda: list(islice(cursor, batch_size))):
+                    yield batch
+        finally:
+            # Kill the server-side cursor when the client goes away mid-stream
+            await self._run(cursor.close)
@@ -0,0 +1,66 @@
+import logging
+import codec
+import partitions
+from publisher import PublisherPool
+
+logger = logging.getLogger(__name__)
+
+QUEUES = ('koili_ipn_queue', 'email_queue', 'sms_queue')
+
+def route(data, enabled_services):
+    """
+    Return the queues a notification should be published to, based on the
+    services enabled for the device.
+    """
+    queues = []
+    if 'IPN' in enabled_services:
+        queues.append('koili_ipn_queue')
+    if 'EMAIL' in enabled_services and data.get('email'):
+        queues.append('email_queue')
+    if 'SMS' in enabled_services:
+        queues.append('sms_queue')
+    return queues
+
+class Dispatcher:
+    """
+    In-process dispatch stage for the API. Holds a long-lived publisher
+    pool, opened on application startup, and publishes each notification
+    to the queues of its enabled services.
+    """
+
+    def __init__(self, publisher=None):
+        self.publisher = publisher or PublisherPool()
+
+    async def start(self):
+        await self.publisher.start()
+        try:
+            await self.publisher.declare(partitions.shard_queues(QUEUES))
+        except BaseException:
+            await self.publisher.stop()
+            raise
+
+    async def stop(self):
+        await self.publisher.stop()
+
+    async def dispatch_many(self, notifications):
+        """
+        Publish a list of (data, message_id) notifications in one batch of
+        publisher confirms. Returns a success flag per notification, true
+        when it was confirmed on every queue it was routed to.
+        """
+        messages = []
+        owners = []
+        for index, (data, message_id) in enumerate(notifications):
+            body, properties = codec.encode(data)
+            queues = partitions.route_to_shards(route(data, data.get('enabledServices', [])), data.get('merchantId'))
+            for queue_name in queues:
+                messages.append((queue_name, body, dict(properties, message_id=message_id)))
+                owners.append(index)
+
+        results = await self.publisher.publish_many(messages)
+        success = [True] * len(notifications)
+        for index, result in zip(owners, results):
+            if result is not None:
+                success[index] = False
+        logger.info("Dispatched %s of %s notifications", success.count(True), len(notifications))
+        return success
@@ -1,9 +1,16 @@
 import smtplib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from requests.adapters import HTTPAdapter
 import logging
 from twilio.base.exceptions import TwilioRestException
 from dotenv import load_dotenv
+from breaker import Destination
 import os
 
 load_dotenv()
@@ -15,51 +22,318 @@ logger = logging.getLogger(__name__)
 # Set Twilio logger to ERROR level
 logging.getLogger('twilio').setLevel(logging.ERROR)
 
-def sms_alert(body, to):
-    account_sid = 'AC65ff0f2cfe0f7a5e1eb253576aa15bcd'
-    auth_token = '03b508b034332d3ba9074805b1504674'
-    client = Client(account_sid, auth_token)
+# SMS Configuration
+TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
+TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
+TWILIO_API_URL = os.getenv('TWILIO_API_URL')
+SMS_CONCURRENCY = int(os.getenv('SMS_CONCURRENCY', 16))
+SMS_RATE_LIMIT = float(os.getenv('SMS_RATE_LIMIT', 50))
+SMS_TIMEOUT = float(os.getenv('SMS_TIMEOUT', 10))
 
-    try:
-        message = client.messages.create(
-            from_='+12075038547',
-            body=body,
-            to=to
-        )
-        logger.info(f"SMS sent successfully. SID: {message.sid}")
-    except TwilioRestException as e:
+# SMTP Configuration
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'true').lower() == 'true'
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 4))
+SMTP_IDLE_CHECK = float(os.getenv('SMTP_IDLE_CHECK', 30))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', 30))
+
+class RateLimiter:
+    """
+    Thread-safe token bucket allowing `rate` acquisitions per second, with
+    bursts of up to `burst`.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def sms_failure(e):
+    """
+    Whether an error says the provider is unhealthy, as opposed to the
+    request itself being rejected (e.g. an invalid number).
+    """
+    if isinstance(e, TwilioRestException):
+        return e.status >= 500 or e.status == 429
+    return True
+
+class SMSClient:
+    """
+    Long-lived Twilio client. Shares one keep-alive HTTP session between
+    sends and sends batches concurrently, bounded by `concurrency` in-flight
+    requests and `rate` messages per second.
+    """
+
+    def __init__(self, account_sid=TWILIO_ACCOUNT_SID, auth_token=TWILIO_AUTH_TOKEN,
+                 from_=TWILIO_PHONE_NUMBER, api_url=TWILIO_API_URL,
+                 concurrency=SMS_CONCURRENCY, rate=SMS_RATE_LIMIT):
+        http_client = TwilioHttpClient(timeout=SMS_TIMEOUT)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        http_client.session.mount('https://', adapter)
+        http_client.session.mount('http://', adapter)
+
+        self.client = Client(account_sid, auth_token, http_client=http_client)
+        if api_url:
+            # Local stand-in for the provider API
+            self.client.api.base_url = api_url
+        self.from_ = from_
+        self.limiter = RateLimiter(rate)
+        self.destination = Destination('sms', concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='sms')
+
+    def send(self, body, to):
+        self.limiter.acquire()
+        with self.destination.call(is_failure=sms_failure):
+            return self.client.messages.create(from_=self.from_, body=body, to=to)
+
+    def send_batch(self, messages):
+        """
+        Send a batch of (body, to) messages concurrently. Returns one entry
+        per message: the created message when sent, otherwise the exception
+        raised.
+        """
+        futures = [self.executor.submit(self.send, body, to) for body, to in messages]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+sms_client = SMSClient()
+
+def log_sms_error(e):
+    if isinstance(e, TwilioRestException):
         logger.error(f"Twilio API error: {e.msg}")
-    except Exception as e:
+    else:
         logger.error(f"Error sending SMS: {str(e)}")
 
-def email_alert(subject, body, to):
+def sms_alert(body, to):
+    try:
+        message = sms_client.send(body, to)
+        logger.info("SMS sent successfully. SID: %s", message.sid)
+        return True
+    except Exception as e:
+        log_sms_error(e)
+        return False
+
+def sms_alerts(messages):
+    """
+    Send a batch of (body, to) SMS concurrently. Returns a success flag per
+    message.
+    """
+    results = sms_client.send_batch(messages)
+    for result in results:
+        if isinstance(result, Exception):
+            log_sms_error(result)
+    flags = [not isinstance(result, Exception) for result in results]
+    logger.info("Sent %s of %s SMS", flags.count(True), len(messages))
+    return flags
+
+def smtp_failure(e):
+    """
+    Whether an error says the SMTP server is unhealthy, as opposed to one
+    message being refused.
+    """
+    return not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError))
+
+class SMTPPool:
+    """
+    Pool of authenticated SMTP sessions. Connections are kept open between
+    sends and health-checked with NOOP when they have been idle for a while;
+    a broken connection is replaced and the send retried once.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=None, password=None,
+                 size=SMTP_POOL_SIZE, starttls=SMTP_STARTTLS, idle_check=SMTP_IDLE_CHECK):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.starttls = starttls
+        self.idle_check = idle_check
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.destination = Destination('smtp', size)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='smtp')
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        if self.starttls:
+            server.starttls()
+        if self.user and self.password:
+            server.login(self.user, self.password)
+        return server
+
+    def _healthy(self, server):
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _discard(self, server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    server, last_used = self.idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - last_used < self.idle_check or self._healthy(server):
+                    return server
+                self._discard(server)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, server, healthy=True):
+        if healthy:
+            self.idle.put((server, time.monotonic()))
+        else:
+            self._discard(server)
+        self.slots.release()
+
+    def _send(self, server, msg):
+        """
+        Send over `server`, reconnecting once if the session was dropped.
+        Returns the connection to keep using.
+        """
+        with self.destination.call(is_failure=smtp_failure):
+            try:
+                server.send_message(msg)
+                return server
+            except (smtplib.SMTPServerDisconnected, OSError):
+                self._discard(server)
+                server = self._connect()
+                server.send_message(msg)
+                return server
+
+    def send(self, msg):
+        server = self.acquire()
+        healthy = True
+        try:
+            server = self._send(server, msg)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            healthy = False
+            raise
+        finally:
+            self.release(server, healthy)
+
+    def send_batch(self, messages):
+        """
+        Send a batch of messages over at most `size` connections. Returns one
+        entry per message: None when sent, otherwise the exception raised.
+        """
+        if not messages:
+            return []
+        chunks = min(self.size, len(messages))
+        results = [None] * len(messages)
+
+        def send_chunk(offset):
+            indexes = range(offset, len(messages), chunks)
+            try:
+                server = self.acquire()
+            except Exception as e:
+                for index in indexes:
+                    results[index] = e
+                return
+            healthy = True
+            try:
+                for index in indexes:
+                    try:
+                        if not healthy:
+                            server = self._connect()
+                            healthy = True
+                        server = self._send(server, messages[index])
+                    except (smtplib.SMTPServerDisconnected, OSError) as e:
+                        results[index] = e
+                        healthy = False
+                    except Exception as e:
+                        results[index] = e
+            finally:
+                self.release(server, healthy)
+
+        for future in [self.executor.submit(send_chunk, offset) for offset in range(chunks)]:
+            future.result()
+        return results
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(server)
+        self.executor.shutdown(wait=True)
+
+smtp_pool = SMTPPool(user=os.getenv('USER'), password=os.getenv('PASSWORD'))
+
+def build_email(subject, body, to):
     msg = EmailMessage()
     msg.set_content(body)
 
     msg['subject'] = subject
     msg['to'] = to
+    msg['from'] = os.getenv('USER')
+    return msg
 
-    user = os.getenv('USER')
-    msg['from'] = user
-    password = os.getenv('PASSWORD')
-
-    try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(user, password)
-        server.send_message(msg)
-        logger.info(f"Email Sent")
-    except smtplib.SMTPAuthenticationError:
+def log_email_error(e):
+    if isinstance(e, smtplib.SMTPAuthenticationError):
         logger.error("SMTP Authentication failed. Check your email and password.")
-    except smtplib.SMTPException as e:
+    elif isinstance(e, smtplib.SMTPException):
         logger.error(f"An error occurred while sending the email: {str(e)}")
-    except Exception as e:
+    else:
         logger.error(f"An unexpected error occurred: {str(e)}")
-    finally:
-        try:
-            server.quit()
-        except:
-            pass
+
+def email_alert(subject, body, to):
+    try:
+        smtp_pool.send(build_email(subject, body, to))
+        logger.info("Email Sent")
+        return True
+    except Exception as e:
+        log_email_error(e)
+        return False
+
+def email_alerts(emails):
+    """
+    Send a batch of (subject, body, to) emails over the SMTP pool. Returns
+    a success flag per email.
+    """
+    results = smtp_pool.send_batch([build_email(subject, body, to) for subject, body, to in emails])
+    for error in results:
+        if error is not None:
+            log_email_error(error)
+    logger.info("Sent %s of %s emails", results.count(None), len(emails))
+    return [error is None for error in results]
 
 def send_notifications(subject, body, email_to, sms_to):
     email_alert(subject, body, email_to)
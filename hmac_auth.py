@@ -0,0 +1,149 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Credentials: FONEPAY_API_KEYS="key1:secret1,key2:secret2" maps each API key
+# to its own secret; FONEPAY_API_SECRET is accepted for any other key.
+FONEPAY_API_KEYS = os.getenv('FONEPAY_API_KEYS', '')
+FONEPAY_API_SECRET = os.getenv('FONEPAY_API_SECRET')
+
+# Replay protection
+NONCE_WINDOW = float(os.getenv('NONCE_WINDOW', 300))
+NONCE_CACHE_SIZE = int(os.getenv('NONCE_CACHE_SIZE', 100000))
+# Other nonces are only remembered while they are in the cache, so they can
+# be replayed once they have left it; set to reject them outright
+NONCE_TIMESTAMPS_ONLY = os.getenv('NONCE_TIMESTAMPS_ONLY', 'false').lower() == 'true'
+
+def generate_signature(api_secret: str, nonce: str, api_key: str, body: str) -> str:
+    message = f" {api_key} {nonce} {body} "
+    signature = base64.b64encode(
+        hmac.new(api_secret.encode(), message.encode(), hashlib.sha512).digest()
+    ).decode()
+    return signature
+
+def parse_api_keys(value):
+    keys = {}
+    for pair in filter(None, value.split(',')):
+        api_key, secret = pair.strip().split(':', 1)
+        keys[api_key] = secret
+    return keys
+
+class NonceCache:
+    """
+    Bounded record of recently used (api key, nonce) pairs. Nonces that are
+    millisecond timestamps (as sent by the acquirer client) must also fall
+    within `window` seconds of the server clock. Other nonces are accepted
+    unless `timestamps_only` is set.
+    """
+
+    def __init__(self, window=NONCE_WINDOW, size=NONCE_CACHE_SIZE, timestamps_only=NONCE_TIMESTAMPS_ONLY):
+        self.window = window
+        self.size = size
+        self.timestamps_only = timestamps_only
+        self.seen = OrderedDict()
+        self.pruned_at = 0.0
+        self.lock = threading.Lock()
+
+    def fresh(self, nonce, now=None):
+        # isdigit() also accepts digits such as '²' that int() rejects
+        if not (nonce.isascii() and nonce.isdecimal()):
+            return not self.timestamps_only
+        try:
+            timestamp = int(nonce) / 1000
+        except (ValueError, OverflowError):
+            # Longer than int() converts or than a float holds
+            return False
+        now = time.time() if now is None else now
+        return abs(now - timestamp) <= self.window
+
+    def use(self, api_key, nonce, now=None):
+        """
+        Record a nonce. Returns False if it was already used within the window.
+        """
+        now = time.time() if now is None else now
+        key = (api_key, nonce)
+        with self.lock:
+            if key in self.seen:
+                return False
+            self.seen[key] = now
+            if len(self.seen) > self.size:
+                self.seen.popitem(last=False)
+            if now - self.pruned_at >= 1:
+                self._prune(now)
+            return True
+
+    def _prune(self, now):
+        # Entries are in insertion order, so expired ones are at the front
+        while self.seen:
+            oldest, used_at = next(iter(self.seen.items()))
+            if now - used_at <= self.window:
+                break
+            del self.seen[oldest]
+        self.pruned_at = now
+
+class HmacVerifier:
+    """
+    Verifies `HmacSHA512 key:nonce:signature` authorization over the raw
+    request body. The HMAC state for each API key, already fed with the
+    " key " prefix of the signed message, is computed once and copied for
+    each request; the rest of the message is fed in pieces instead of
+    being assembled, and signatures are compared in constant time.
+    """
+
+    # Prefix states kept for keys verified against the default secret
+    MAX_DEFAULT_PREFIXES = 1024
+
+    def __init__(self, keys=None, default_secret=FONEPAY_API_SECRET):
+        if keys is None:
+            keys = parse_api_keys(FONEPAY_API_KEYS)
+        self.prefixes = {
+            api_key: self._prefix(secret.encode(), api_key)
+            for api_key, secret in keys.items()
+        }
+        self.default_secret = default_secret.encode() if default_secret else None
+
+    @staticmethod
+    def _prefix(secret, api_key):
+        mac = hmac.new(secret, digestmod=hashlib.sha512)
+        mac.update(b" " + api_key.encode() + b" ")
+        return mac
+
+    def begin(self, api_key, nonce):
+        """
+        Start verifying a request whose body arrives in pieces. Returns an
+        HMAC to update() with the body and pass to finish(), or None when
+        the key is unknown.
+        """
+        prefix = self.prefixes.get(api_key)
+        if prefix is None:
+            if self.default_secret is None:
+                return None
+            prefix = self._prefix(self.default_secret, api_key)
+        mac = prefix.copy()
+        mac.update(nonce.encode() + b" ")
+        return mac
+
+    def finish(self, api_key, mac, signature):
+        if mac is None:
+            return False
+        mac.update(b" ")
+        valid = hmac.compare_digest(base64.b64encode(mac.digest()), signature.encode())
+
+        # Only remember keys that signed correctly, so callers cannot fill the cache
+        if valid and api_key not in self.prefixes and len(self.prefixes) < self.MAX_DEFAULT_PREFIXES:
+            self.prefixes[api_key] = self._prefix(self.default_secret, api_key)
+        return valid
+
+    def verify(self, api_key, nonce, signature, body):
+        mac = self.begin(api_key, nonce)
+        if mac is None:
+            return False
+        mac.update(body)
+        return self.finish(api_key, mac, signature)
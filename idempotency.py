@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Idempotency configuration
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 100000))
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 86400))
+
+def idempotency_key(merchant_id, unique_id, retrieval_reference_number):
+    return f"{merchant_id}:{unique_id}:{retrieval_reference_number}"
+
+class LRUSet:
+    """
+    Bounded, thread-safe set that forgets the least recently added keys.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.keys
+
+    def add(self, key):
+        with self.lock:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+class IdempotencyStore:
+    """
+    Remembers the response sent for each (merchantId, uniqueId,
+    retrievalReferenceNumber) so that retried requests get the original
+    response back instead of being processed again.
+
+    The authority is the `idempotency` collection, whose _id is the key
+    (so inserts are unique) and whose createdAt field has a TTL index. An
+    in-memory LRU of recent keys answers repeats without a round trip.
+    """
+
+    def __init__(self, db, size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.size = size
+        self.responses = OrderedDict()
+        self.duplicates = 0
+
+    async def start(self):
+        await self.db.ensure_idempotency_index(self.ttl)
+
+    def _remember(self, key, response):
+        self.responses[key] = response
+        self.responses.move_to_end(key)
+        while len(self.responses) > self.size:
+            self.responses.popitem(last=False)
+
+    def _repeated(self, count):
+        self.duplicates += count
+        logger.info("%s duplicate requests answered before rate limiting", count)
+
+    def recall_many(self, keys):
+        """
+        The original response per key that is remembered in this process,
+        or None; answers retries without a round trip.
+        """
+        results = [self.responses.get(key) for key in keys]
+        repeated = len(keys) - results.count(None)
+        if repeated:
+            self._repeated(repeated)
+        return results
+
+    async def find_many(self, keys):
+        """
+        The original response per key, or None for keys not claimed yet.
+        Unlike claim_many() nothing is recorded for new keys.
+        """
+        results = [self.responses.get(key) for key in keys]
+        unknown = list({key for key, original in zip(keys, results) if original is None})
+        if unknown:
+            stored = await self.db.find_idempotency_keys(unknown)
+            for index, key in enumerate(keys):
+                if results[index] is None and key in stored:
+                    results[index] = stored[key]['response']
+                    self._remember(key, results[index])
+        repeated = len(keys) - results.count(None)
+        if repeated:
+            self._repeated(repeated)
+        return results
+
+    async def claim(self, key, response):
+        """
+        Record `response` as the answer for `key`. Returns None when this is
+        the first request with the key, otherwise the original response.
+        """
+        original = self.responses.get(key)
+        if original is None:
+            try:
+                await self.db.insert_idempotency_key({
+                    "_id": key,
+                    "response": response,
+                    "createdAt": datetime.now()
+                })
+                self._remember(key, response)
+                return None
+            except DuplicateKeyError:
+                document = await self.db.find_idempotency_key(key)
+                original = document['response'] if document else response
+                self._remember(key, original)
+
+        self.duplicates += 1
+        logger.info("Duplicate request %s", key)
+        return original
+
+    async def claim_many(self, claims):
+        """
+        claim() for a batch of (key, response) pairs with a single insert.
+        Returns, per pair, None for the first request with the key and
+        otherwise the original response; a key repeated within the batch
+        is a duplicate of its first occurrence.
+        """
+        results = [None] * len(claims)
+        indexes = []
+        documents = []
+        now = datetime.now()
+        for index, (key, response) in enumerate(claims):
+            original = self.responses.get(key)
+            if original is not None:
+                results[index] = original
+            else:
+                indexes.append(index)
+                documents.append({"_id": key, "response": response, "createdAt": now})
+
+        duplicates = set()
+        if documents:
+            try:
+                await self.db.insert_idempotency_keys(documents)
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                if any(error.get('code') != 11000 for error in errors):
+                    # Keep the keys that were stored from blocking retries
+                    rejected = {error['index'] for error in errors}
+                    await self.db.delete_idempotency_keys([
+                        document["_id"] for position, document in enumerate(documents) if position not in rejected
+                    ])
+                    raise
+                duplicates = {indexes[error['index']] for error in errors}
+
+        stored = {}
+        if duplicates:
+            stored = await self.db.find_idempotency_keys(list({claims[index][0] for index in duplicates}))
+        for index in indexes:
+            key, response = claims[index]
+            if index in duplicates:
+                document = stored.get(key)
+                results[index] = document['response'] if document else response
+            self._remember(key, results[index] or response)
+
+        repeated = len(claims) - results.count(None)
+        if repeated:
+            self.duplicates += repeated
+            logger.info("%s duplicate requests in batch", repeated)
+        return results
+
+    async def release_many(self, keys):
+        for key in keys:
+            self.responses.pop(key, None)
+        await self.db.delete_idempotency_keys(keys)
+
+    async def release(self, key):
+        """
+        Forget a key whose request failed, so that a retry is processed.
+        """
+        self.responses.pop(key, None)
+        await self.db.delete_idempotency_key(key)
@@ -1,5 +1,6 @@
-import requests
-import json
+import asyncio
+import httpx
+from breaker import Destination, Unavailable
 from dotenv import load_dotenv
 import os
 import sys
@@ -19,35 +20,108 @@ headers = {
     "Subscription-Key": os.getenv('Subscription-Key')
 }
 
-def main(amount, machine_identifier):
-    # Payload data
-    payload = {
-        "amount": float(amount),
-        "machineIdentifier": machine_identifier
-    }
-
-    # Make the POST request
-    try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        
+# Client configuration
+IPN_TIMEOUT = float(os.getenv('IPN_TIMEOUT', 10))
+IPN_CONCURRENCY = int(os.getenv('IPN_CONCURRENCY', 50))
+
+class IPNClient:
+    """
+    Reusable async Koili IPN client. Keeps a keep-alive connection pool to
+    the IPN endpoint; requests in flight are bounded by the destination's
+    adaptive limit, at most `concurrency`.
+    """
+
+    def __init__(self, endpoint=None, concurrency=IPN_CONCURRENCY, timeout=IPN_TIMEOUT):
+        self.endpoint = endpoint or url
+        self.timeout = timeout
+        self.destination = Destination('koili_ipn', concurrency)
+        self.client = httpx.AsyncClient(
+            # requests used to drop unset headers; httpx rejects them
+            headers={name: value for name, value in headers.items() if value is not None},
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        )
+
+    async def send(self, amount, machine_identifier, timeout=None):
+        """
+        Send one IPN. Returns True when the endpoint accepted it.
+        """
+        try:
+            payload = {
+                "amount": float(amount),
+                "machineIdentifier": machine_identifier
+            }
+        except (TypeError, ValueError):
+            logger.error(f"Invalid IPN amount: {amount!r}")
+            return False
+
+        try:
+            started = await self.destination.acquire_async()
+        except Unavailable as e:
+            logger.error(f"Skipped IPN: {e}")
+            return False
+
+        healthy = False
+        try:
+            response = await self.client.post(self.endpoint, json=payload, timeout=timeout or self.timeout)
+            healthy = response.status_code < 500
+        except httpx.HTTPError as e:
+            logger.error(f"An error occurred: {e}")
+            return False
+        finally:
+            self.destination.release(started, healthy)
+
         # Check the response
         if response.status_code == 200:
-            result = response.json()
-            logger.info(f"Status Code: {response.status_code}")
-            logger.info(f"Message: {result['message']}")
-            logger.info(f"Response Code: {result['responseCode']}")
-        else:
-            logger.error(f"Error: Status Code {response.status_code}")
-            logger.error(f"Response: {response.text}")
+            # The IPN was accepted whatever the body says; failing it here
+            # would only have it sent again
+            try:
+                result = response.json()
+            except ValueError:
+                result = None
+            if not isinstance(result, dict):
+                logger.warning("IPN accepted with an unexpected response: %s", response.text)
+                return True
+            logger.info("Status Code: %s", response.status_code)
+            logger.info("Message: %s", result.get('message'))
+            logger.info("Response Code: %s", result.get('responseCode'))
+            return True
+        logger.error(f"Error: Status Code {response.status_code}")
+        logger.error(f"Response: {response.text}")
+        return False
+
+    async def send_many(self, notifications, timeout=None):
+        """
+        Send (amount, machine_identifier) pairs concurrently. Returns a
+        success flag per notification; an error sending one only fails that
+        one, as the others may already have been delivered.
+        """
+        results = await asyncio.gather(*[
+            self.send(amount, machine_identifier, timeout) for amount, machine_identifier in notifications
+        ], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error sending IPN: {str(result)}")
+        return [result is True for result in results]
+
+    async def close(self):
+        await self.client.aclose()
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"An error occurred: {e}")
+def main(amount, machine_identifier):
+    async def send():
+        client = IPNClient()
+        try:
+            return await client.send(amount, machine_identifier)
+        finally:
+            await client.close()
+
+    return asyncio.run(send())
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
         logger.error("Usage: python koili_ipn.py <amount> <machine_identifier>")
         sys.exit(1)
-    
+
     amount = sys.argv[1]
     machine_identifier = sys.argv[2]
-    main(amount, machine_identifier)
\ No newline at end of file
+    main(amount, machine_identifier)
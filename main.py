@@ -1,19 +1,28 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, Request
-from pydantic import BaseModel, Field, EmailStr, validator, ValidationError
-from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, StringConstraints, TypeAdapter, ValidationError
+from typing import Annotated, List, Optional
 from datetime import datetime
-import hmac
-import hashlib
+from bson import ObjectId
+from bson.errors import InvalidId
 import base64
-import logging
 import json
-import subprocess
-import sys
+import logging
+import math
+import metrics
 import os
+import time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-import email_validator
-from pymongo import MongoClient
-from bson import ObjectId
+from bulk import BULK_BATCH_SIZE, BULK_MAX_BYTES, BULK_MAX_ITEMS, BulkFormatError, BulkParser, BulkTooLargeError
+from db import Database
+from dispatcher import Dispatcher
+from hmac_auth import HmacVerifier, NonceCache
+from idempotency import IdempotencyStore, idempotency_key
+from outbox import OutboxRelay, dispatch_record
+from rate_limit import RequestLimiter
+from registry_cache import RegistryCache
+from transaction_writer import TransactionWriter
 
 load_dotenv()
 
@@ -21,87 +30,127 @@ load_dotenv()
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-
-# Load API credentials from environment variables
-API_SECRET = os.getenv('FONEPAY_API_SECRET')
+# Transaction history: transactions per page by default and at most, and
+# documents fetched per cursor round trip
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 10000))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 100000))
+HISTORY_BATCH_SIZE = int(os.getenv('HISTORY_BATCH_SIZE', 500))
+
+db = Database()
+dispatcher = Dispatcher()
+outbox_relay = OutboxRelay(db, dispatcher)
+transaction_writer = TransactionWriter(db, on_flush=outbox_relay.wake)
+registry_cache = RegistryCache(db)
+idempotency_store = IdempotencyStore(db)
+rate_limiter = RequestLimiter(db)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db.connect()
+    await db.ensure_indexes()
+    await idempotency_store.start()
+    await rate_limiter.start()
+    await transaction_writer.start()
+    await registry_cache.start()
+    # Connects to RabbitMQ in the background: requests only need MongoDB
+    await outbox_relay.start()
+    yield
+    # Flush buffered transactions before the relay publishes what is left
+    await transaction_writer.stop()
+    await outbox_relay.stop()
+    await dispatcher.stop()
+    await registry_cache.stop()
+    await db.close()
+
+app = FastAPI(lifespan=lifespan)
+
+HMAC_STAGE = metrics.STAGE_LATENCY.labels('hmac')
+REGISTRY_STAGE = metrics.STAGE_LATENCY.labels('registry')
+
+class MetricsMiddleware:
+    """
+    Records the latency of every HTTP request by route and status. A plain
+    ASGI middleware, so it adds no extra request/response objects.
+    """
 
-# MongoDB connection
-Mongodb_URL = MongoClient(os.getenv('DB_URL'))
-db = Mongodb_URL[os.getenv('DB_NAME')]
-collection = db['merchant-registry']
-transaction_collection = db['transaction']
+    def __init__(self, app):
+        self.app = app
+        self.paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            if self.paths is None:
+                self.paths = {route.path for route in app.routes}
+            # Unknown paths share one label to keep the series bounded
+            path = scope['path'] if scope['path'] in self.paths else 'other'
+            metrics.REQUEST_LATENCY.labels(path, status[0]).observe(time.perf_counter() - started)
+
+app.add_middleware(MetricsMiddleware)
+
+metrics.Gauge(
+    'transaction_writer_pending', 'Transactions buffered for writing',
+    collect=lambda: transaction_writer.queue.qsize()
+)
+metrics.Gauge(
+    'registry_cache', 'Registry cache size and lookup counts', ('stat',),
+    collect=lambda: {(stat,): value for stat, value in registry_cache.stats().items()}
+)
+metrics.Gauge(
+    'idempotency_duplicates', 'Repeated requests answered with the original response',
+    collect=lambda: idempotency_store.duplicates
+)
+metrics.Gauge(
+    'publisher', 'Publisher pool counters and confirm latency', ('stat',),
+    collect=lambda: {(stat,): value for stat, value in dispatcher.publisher.stats.snapshot().items()}
+)
+
+# API credentials are loaded from environment variables
+hmac_verifier = HmacVerifier()
+nonce_cache = NonceCache()
+
+# Constraints are checked by pydantic-core itself; no Python-level
+# validators run on the request path.
+MobileNumber = Annotated[str, StringConstraints(pattern=r'^\d{10}$')]
+# Optional fields keep accepting an empty string, as they always have
+OptionalMobileNumber = Annotated[str, StringConstraints(pattern=r'^(\d{10})?$')]
+Email = Annotated[str, StringConstraints(pattern=r'^([^@\s]+@[^@\s]+\.[^@\s]+)?$')]
+Amount = Annotated[str, StringConstraints(pattern=r'^[\d.]*\d[\d.]*$')]
+NotificationType = Annotated[str, StringConstraints(pattern=r'^(alert|otp)?$')]
 
 class Properties(BaseModel):
     commission: Optional[float] = None
     sessionSrlNo: Optional[str] = None
+    # "YYYY-MM-DD HH:MM:SS" (ISO 8601 forms are accepted as well)
     txnDate: Optional[datetime] = None
-    secondaryMobileNumber: Optional[str] = None
-    email: Optional[str] = None
+    secondaryMobileNumber: Optional[OptionalMobileNumber] = None
+    email: Optional[Email] = None
     initiator: Optional[str] = None
 
-    @validator('secondaryMobileNumber')
-    def validate_secondary_mobile_number(cls, v):
-        if v and (not v.isdigit() or len(v) != 10):
-            raise ValueError('Payload Invalid')
-        return v
-
-    @validator('txnDate', pre=True)
-    def parse_datetime(cls, v):
-        if isinstance(v, str):
-            try:
-                return datetime.strptime(v, "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                raise ValueError("Payload Invalid")
-        return v
-
-    @validator('email')
-    def validate_email(cls, v):
-        if v:
-            try:
-                email_validator.validate_email(v)
-            except email_validator.EmailNotValidError:
-                raise ValueError("Payload Invalid")
-        return v
-
-    @validator('commission')
-    def validate_commission(cls, v):
-        if v is not None:
-            try:
-                float(v)
-            except ValueError:
-                raise ValueError("Payload Invalid")
-        return v
-
 class SendNotificationRequest(BaseModel):
-    mobileNumber: str = Field(..., pattern=r'^\d{10}$')
+    mobileNumber: MobileNumber
     merchantId: str
     terminalId: str
     retrievalReferenceNumber: str
-    amount: str
+    amount: Amount
     remark1: str
-    type: Optional[str] = None
+    type: Optional[NotificationType] = None
     uniqueId: str
     properties: Optional[Properties] = None
 
-    @validator('amount')
-    def validate_amount(cls, v):
-        if not v.replace('.', '').isdigit():
-            raise ValueError('Payload Invalid')
-        return v
-
-    @validator('type')
-    def validate_type(cls, v):
-        if v and v not in ['alert', 'otp']:
-            raise ValueError('Payload Invalid')
-        return v
-
-    @validator('mobileNumber')
-    def validate_mobile_number(cls, v):
-        if not v.isdigit() or len(v) != 10:
-            raise ValueError('Payload Invalid')
-        return v
-
 class SendNotificationResponse(BaseModel):
     status: bool
     message: str
@@ -109,10 +158,29 @@ class SendNotificationResponse(BaseModel):
     data: dict
     httpStatus: int
 
+class BulkItemResult(BaseModel):
+    index: int
+    status: bool
+    message: str
+    code: str
+    data: Optional[dict] = None
+    httpStatus: int
+    # Seconds to wait before retrying an item refused by a rate limit
+    retryAfter: Optional[int] = None
+
 class CallbackRequest(BaseModel):
     merchantId: str
     terminalId: str
 
+class HistoryRequest(BaseModel):
+    merchantId: str
+    terminalId: str
+    # Optional range of properties.txnDate: fromDate <= txnDate < toDate
+    fromDate: Optional[datetime] = None
+    toDate: Optional[datetime] = None
+    cursor: Optional[str] = None
+    limit: Optional[Annotated[int, Field(ge=1, le=HISTORY_MAX_PAGE_SIZE)]] = None
+
 class TransactionNotificationDetail(BaseModel):
     mobileNumber: str
     merchantId: str
@@ -127,51 +195,53 @@ class TransactionNotificationDetail(BaseModel):
 class CallbackResponse(BaseModel):
     transactionNotificationDetails: List[TransactionNotificationDetail]
 
-def generate_signature(api_secret: str, nonce: str, api_key: str, body: str) -> str:
-    message = f" {api_key} {nonce} {body} "
-    signature = base64.b64encode(
-        hmac.new(api_secret.encode(), message.encode(), hashlib.sha512).digest()
-    ).decode()
-    return signature
+TRANSACTION_DETAIL_PROJECTION = {**dict.fromkeys(TransactionNotificationDetail.model_fields, 1), '_id': 0}
+# The history also reads the pagination key
+HISTORY_PROJECTION = {**dict.fromkeys(TransactionNotificationDetail.model_fields, 1), 'timestamp': 1}
 
-async def verify_hmac(request: Request, authorization: str = Header(...)):
-    logger.debug(f"Received authorization header: {authorization}")
+def parse_authorization(authorization):
+    """
+    Split an `HmacSHA512 key:nonce:signature` header into its parts,
+    rejecting malformed headers and expired nonces.
+    """
     try:
         auth_type, auth_data = authorization.split(" ", 1)
-        if auth_type != "HmacSHA512":
-            raise HTTPException(status_code=401, detail={"message": "Invalid authorization type", "code": "2"})
-
         api_key, nonce, signature = auth_data.split(":")
-        logger.debug(f"Parsed auth data - API Key: {api_key}, Nonce: {nonce}")
+    except ValueError:
+        raise HTTPException(status_code=401, detail={"message": "Invalid authorization data", "code": "2"})
 
-        # Get the request body
-        body = await request.body()
-        body_str = body.decode()
-        logger.debug(f"Request body: {body_str}")
+    if auth_type != "HmacSHA512":
+        raise HTTPException(status_code=401, detail={"message": "Invalid authorization type", "code": "2"})
 
-        # Verify the signature
-        expected_signature = generate_signature(API_SECRET, nonce, api_key, body_str)
-        
-        logger.debug(f"Expected signature: {expected_signature}")
-        logger.debug(f"Received signature: {signature}")
+    # Reject replays before reading the body or touching the database
+    if not nonce_cache.fresh(nonce):
+        raise HTTPException(status_code=401, detail={"message": "Nonce expired", "code": "2"})
+    return api_key, nonce, signature
 
-        if signature != expected_signature:
-            raise HTTPException(status_code=401, detail={"message": "Invalid signature", "code": "2"})
+def check_signature(valid, api_key, nonce):
+    if not valid:
+        logger.error("Authentication error: invalid signature")
+        raise HTTPException(status_code=401, detail={"message": "Invalid signature", "code": "2"})
 
-    except Exception as e:
-        logger.error(f"Authentication error: {str(e)}")
-        raise HTTPException(status_code=401, detail={"message": "Invalid authorization data", "code": "2"})
+    if not nonce_cache.use(api_key, nonce):
+        raise HTTPException(status_code=401, detail={"message": "Nonce already used", "code": "2"})
+
+async def verify_hmac(request: Request, authorization: str = Header(...)):
+    started = time.perf_counter()
+    api_key, nonce, signature = parse_authorization(authorization)
+    body = await request.body()
+    check_signature(hmac_verifier.verify(api_key, nonce, signature, body), api_key, nonce)
+    HMAC_STAGE.observe(time.perf_counter() - started)
 
-def get_device_info(merchant_id: str, terminal_id: str):
+async def get_device_info(merchant_id: str, terminal_id: str):
     """
-    Connect to MongoDB, check for merchantId and terminalId, 
-    and retrieve enabled services and machine identifier.
+    Check the merchant registry (through the cache) for merchantId and
+    terminalId, and retrieve enabled services and machine identifier.
     """
-    device = collection.find_one({
-        "fonepay.merchantId": merchant_id,
-        "fonepay.terminalId": terminal_id
-    })
-    
+    started = time.perf_counter()
+    device = await registry_cache.get_device(merchant_id, terminal_id)
+    REGISTRY_STAGE.observe(time.perf_counter() - started)
+
     if not device:
         logger.error(f"No device found for merchantId: {merchant_id} and terminalId: {terminal_id}")
         return None, []
@@ -179,53 +249,106 @@ def get_device_info(merchant_id: str, terminal_id: str):
     machine_identifier = device.get('machineIdentifier')
     enabled_services = device.get('enabledServices', [])
     
-    logger.info(f"Found device: {machine_identifier} with enabled services: {enabled_services}")
+    logger.info("Found device: %s with enabled services: %s", machine_identifier, enabled_services)
     return machine_identifier, enabled_services
 
-@app.post("/notification/send", response_model=SendNotificationResponse)
-async def send_notification(request: SendNotificationRequest, authorized: bool = Depends(verify_hmac)):
-    logger.info(f"Received notification request for mobile number: {request.mobileNumber}")
+def notification_response(mobile_number):
+    return SendNotificationResponse(
+        status=True,
+        message="SMS delivered successfully",
+        code="0",
+        data={
+            "mobileNumber": mobile_number,
+            "msgId": f"MN-{int(datetime.now().timestamp())}"
+        },
+        httpStatus=200
+    )
+
+def notification_transaction(request, machine_identifier, enabled_services, key):
+    """
+    Transaction document for a notification request, carrying the pending
+    dispatch of its notification.
+    """
+    transaction_details = request.model_dump()
+    properties = transaction_details['properties'] or {}
+    data = {
+        'amount': request.amount,
+        'mobileNumber': request.mobileNumber,
+        'email': properties.get('email'),
+        'merchantId': request.merchantId,
+        'terminalId': request.terminalId,
+        'commission': properties.get('commission'),
+        'machineIdentifier': machine_identifier,
+        'enabledServices': enabled_services
+    }
+    return dict(transaction_details, timestamp=datetime.now(), dispatch=dispatch_record(data, key))
+
+@app.post(
+    "/notification/send",
+    response_model=SendNotificationResponse,
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {
+            "schema": SendNotificationRequest.model_json_schema()
+        }}
+    }}
+)
+async def send_notification(http_request: Request, authorized: bool = Depends(verify_hmac)):
+    try:
+        # The body was already read (and cached) by verify_hmac; parse and
+        # validate it in a single pass
+        request = SendNotificationRequest.model_validate_json(await http_request.body())
+    except ValidationError as e:
+        logger.error(f"Validation error: {str(e)}")
+        raise HTTPException(status_code=400, detail={"message": "Payload Invalid", "code": "1"})
+
+    logger.info("Received notification request for mobile number: %s", request.mobileNumber)
+
+    # Retries from the acquirer get the original response back, whatever
+    # the rate limits say: known keys are answered from memory up front and
+    # a request the limits refuse is looked up before it is turned away
+    key = idempotency_key(request.merchantId, request.uniqueId, request.retrievalReferenceNumber)
+    original, = idempotency_store.recall_many([key])
+    if original is not None:
+        return SendNotificationResponse(**original)
+
+    # Shed floods from a terminal or to a number before any database work
+    limited = await rate_limiter.acquire(request.merchantId, request.terminalId, request.mobileNumber)
+    if limited is not None:
+        original, = await idempotency_store.find_many([key])
+        if original is not None:
+            return SendNotificationResponse(**original)
+        _, retry_after = limited
+        raise HTTPException(
+            status_code=429,
+            detail={"message": "Too many requests", "code": "6"},
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
 
     try:
         # Get device info
-        machine_identifier, enabled_services = get_device_info(request.merchantId, request.terminalId)
+        machine_identifier, enabled_services = await get_device_info(request.merchantId, request.terminalId)
         
         if not machine_identifier:
             raise HTTPException(status_code=402, detail={"message": "Device not found", "code": "3"})
 
-        # Save transaction details to MongoDB
-        transaction_details = request.dict()
-        transaction_details['timestamp'] = datetime.now()
-        transaction_collection.insert_one(transaction_details)
-
-        response = SendNotificationResponse(
-            status=True,
-            message="SMS delivered successfully",
-            code="0",
-            data={
-                "mobileNumber": request.mobileNumber,
-                "msgId": f"MN-{int(datetime.now().timestamp())}"
-            },
-            httpStatus=200
-        )
+        response = notification_response(request.mobileNumber)
+
+        original = await idempotency_store.claim(key, response.model_dump())
+        if original is not None:
+            return SendNotificationResponse(**original)
 
-        if response.status:
-            message = json.dumps({
-                'amount': request.amount,
-                'mobileNumber': request.mobileNumber,
-                'email': request.properties.email if request.properties else None,
-                'merchantId': request.merchantId,
-                'terminalId': request.terminalId,
-                'commission': request.properties.commission if request.properties else None,
-                'machineIdentifier': machine_identifier,
-                'enabledServices': enabled_services
-            })
-            
-            receiver_script = os.path.join(os.path.dirname(__file__), 'receiver.py')
-            subprocess.Popen([sys.executable, receiver_script, message], 
-                     stdout=subprocess.DEVNULL, 
-                     stderr=subprocess.DEVNULL)
-            logger.info(f"Called receiver.py with message: {message}")
+        # Save transaction details to MongoDB together with the pending
+        # notification; the outbox relay publishes it once it is stored.
+        # write() returns once the batch is acknowledged, so a failed
+        # insert releases the key and the acquirer's retry is processed.
+        try:
+            await transaction_writer.write(
+                notification_transaction(request, machine_identifier, enabled_services, key)
+            )
+        except Exception:
+            await idempotency_store.release(key)
+            raise
 
         return response
 
@@ -233,46 +356,271 @@ async def send_notification(request: SendNotificationRequest, authorized: bool =
         logger.error(f"Validation error: {str(e)}")
         raise HTTPException(status_code=400, detail={"message": "Payload Invalid", "code": "1"})
 
-@app.post("/callback", response_model=CallbackResponse)
-async def callback(request: CallbackRequest, authorized: bool = Depends(verify_hmac)):
-    logger.info(f"Received callback request for merchant: {request.merchantId}")
-    
-    # Check if merchantId exists
-    merchant = collection.find_one({"fonepay.merchantId": request.merchantId})
-    if not merchant:
-        raise HTTPException(status_code=403, detail={"message": "Invalid MerchantID", "code": "4"})
+def payload_too_large(message):
+    return HTTPException(status_code=413, detail={"message": message, "code": "1"})
+
+def bulk_error(index, status_code, message, code, retry_after=None):
+    return BulkItemResult(index=index, status=False, message=message, code=code, httpStatus=status_code,
+                          retryAfter=retry_after)
+
+async def process_bulk_batch(items, offset):
+    """
+    Validate, look up, rate-limit, claim and store one batch of bulk items,
+    with one registry query, one take per rate limit bucket, one
+    idempotency insert and one insert_many. Returns a result per item.
+    """
+    results = [None] * len(items)
+    requests = []
+    for position, item in enumerate(items):
+        try:
+            requests.append((position, SendNotificationRequest.model_validate_json(item)))
+        except ValidationError:
+            results[position] = bulk_error(offset + position, 400, "Payload Invalid", "1")
+
+    started = time.perf_counter()
+    try:
+        devices = await registry_cache.get_devices([(request.merchantId, request.terminalId) for _, request in requests])
+    except Exception as e:
+        logger.error(f"Failed to look up bulk devices: {str(e)}")
+        for position, _ in requests:
+            results[position] = bulk_error(offset + position, 500, "Internal Server Error", "5")
+        return results
+    REGISTRY_STAGE.observe(time.perf_counter() - started)
+
+    accepted = []
+    for position, request in requests:
+        device = devices.get((request.merchantId, request.terminalId))
+        if not device or not device.get('machineIdentifier'):
+            results[position] = bulk_error(offset + position, 402, "Device not found", "3")
+            continue
+        key = idempotency_key(request.merchantId, request.uniqueId, request.retrievalReferenceNumber)
+        accepted.append((position, request, device, key, notification_response(request.mobileNumber).model_dump()))
+
+    # Retried items are answered before the rate limits, as in send_notification
+    originals = idempotency_store.recall_many([key for _, _, _, key, _ in accepted])
+    for (position, *_), original in zip(accepted, originals):
+        if original is not None:
+            results[position] = BulkItemResult(index=offset + position, **original)
+    accepted = [item for item, original in zip(accepted, originals) if original is None]
+
+    # A key repeated within the batch is a duplicate of its first item and
+    # takes no token of its own
+    first = {}
+    for position, request, _, key, _ in accepted:
+        first.setdefault(key, (position, request))
+    limits = dict(zip(first, await rate_limiter.acquire_many([
+        (request.merchantId, request.terminalId, request.mobileNumber) for _, request in first.values()
+    ], bulk=True)))
+    refused = [item for item in accepted if limits[item[3]] is not None]
+    accepted = [item for item in accepted if limits[item[3]] is None]
+
+    try:
+        if refused:
+            originals = await idempotency_store.find_many([key for _, _, _, key, _ in refused])
+            for (position, _, _, key, _), original in zip(refused, originals):
+                if original is not None:
+                    results[position] = BulkItemResult(index=offset + position, **original)
+                else:
+                    results[position] = bulk_error(
+                        offset + position, 429, "Too many requests", "6", math.ceil(limits[key][1])
+                    )
+        originals = await idempotency_store.claim_many([(key, response) for _, _, _, key, response in accepted])
+    except Exception as e:
+        logger.error(f"Failed to claim bulk items: {str(e)}")
+        for position, *_ in refused + accepted:
+            if results[position] is None:
+                results[position] = bulk_error(offset + position, 500, "Internal Server Error", "5")
+        return results
+
+    new = []
+    for (position, request, device, key, response), original in zip(accepted, originals):
+        if original is not None:
+            # Retried item: answer with the original response
+            results[position] = BulkItemResult(index=offset + position, **original)
+        else:
+            new.append((position, request, device, key, response))
+
+    if new:
+        try:
+            errors = await transaction_writer.write_many([
+                notification_transaction(request, device['machineIdentifier'], device.get('enabledServices', []), key)
+                for _, request, device, key, _ in new
+            ])
+        except Exception as e:
+            logger.error(f"Failed to store bulk items: {str(e)}")
+            errors = [e] * len(new)
+        failed = []
+        for (position, _, _, key, response), error in zip(new, errors):
+            if error is None:
+                results[position] = BulkItemResult(index=offset + position, **response)
+            else:
+                failed.append(key)
+                results[position] = bulk_error(offset + position, 500, "Internal Server Error", "5")
+        if failed:
+            try:
+                await idempotency_store.release_many(failed)
+            except Exception as e:
+                # The items already failed; only their retries are affected
+                logger.error(f"Failed to release {len(failed)} bulk idempotency keys: {str(e)}")
+    return results
+
+async def bulk_results(items):
+    # A failing batch must not cut the response short: earlier batches are
+    # already stored and every item gets its result line
+    for offset in range(0, len(items), BULK_BATCH_SIZE):
+        batch = items[offset:offset + BULK_BATCH_SIZE]
+        try:
+            results = await process_bulk_batch(batch, offset)
+        except Exception as e:
+            logger.error(f"Failed to process bulk items {offset} to {offset + len(batch) - 1}: {str(e)}")
+            results = [bulk_error(offset + position, 500, "Internal Server Error", "5") for position in range(len(batch))]
+        yield ''.join(result.model_dump_json() + '\n' for result in results)
+
+@app.post(
+    "/notification/bulk",
+    response_class=StreamingResponse,
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": TypeAdapter(List[SendNotificationRequest]).json_schema()},
+            "application/x-ndjson": {"schema": SendNotificationRequest.model_json_schema()}
+        }
+    }}
+)
+async def send_notifications_bulk(http_request: Request, authorization: str = Header(...)):
+    """
+    Accept many notification requests under one signature, as NDJSON or as
+    a JSON array. Responds with one NDJSON result line per item, in order,
+    streamed as the items are processed in batches.
+    """
+    api_key, nonce, signature = parse_authorization(authorization)
+    mac = hmac_verifier.begin(api_key, nonce)
+    if mac is None:
+        # Unknown key: refuse before reading the body
+        check_signature(False, api_key, nonce)
+    parser = BulkParser()
+    items = []
+    error = None
+    received = 0
+
+    # The signature covers the whole body, so nothing can be acted upon
+    # before the end: the body is hashed and split into items as it
+    # arrives, and the items are kept as JSON text until it checks out.
+    # Oversized bodies are refused as soon as they exceed the limits.
+    async for chunk in http_request.stream():
+        received += len(chunk)
+        if received > BULK_MAX_BYTES:
+            raise payload_too_large(f"At most {BULK_MAX_BYTES} bytes per request")
+        mac.update(chunk)
+        if error is None:
+            try:
+                items.extend(parser.feed(chunk))
+            except BulkTooLargeError:
+                raise payload_too_large(f"At most {BULK_MAX_ITEMS} items per request")
+            except BulkFormatError as e:
+                error = e
+                items = []
+    if error is None:
+        try:
+            items.extend(parser.close())
+        except BulkTooLargeError:
+            raise payload_too_large(f"At most {BULK_MAX_ITEMS} items per request")
+        except BulkFormatError as e:
+            error = e
+    check_signature(hmac_verifier.finish(api_key, mac, signature), api_key, nonce)
+
+    if error is not None:
+        logger.error(f"Invalid bulk payload: {str(error)}")
+        raise HTTPException(status_code=400, detail={"message": "Payload Invalid", "code": "1"})
+
+    logger.info("Received bulk request with %s items", len(items))
+    return StreamingResponse(bulk_results(items), media_type="application/x-ndjson")
 
-    # Check if terminalId exists
-    terminal = collection.find_one({"fonepay.merchantId": request.merchantId, "fonepay.terminalId": request.terminalId})
+async def check_device(merchant_id, terminal_id):
+    # Resolve merchant and terminal with a single (cached) registry lookup.
+    # The merchant-only lookup is needed just to pick the error code.
+    terminal = await registry_cache.get_device(merchant_id, terminal_id)
     if not terminal:
+        merchant = await registry_cache.get_merchant(merchant_id)
+        if not merchant:
+            raise HTTPException(status_code=403, detail={"message": "Invalid MerchantID", "code": "4"})
         raise HTTPException(status_code=403, detail={"message": "Invalid TerminalID", "code": "4"})
-    
-    # Retrieve the last 5 transactions from MongoDB
-    transactions = list(transaction_collection.find(
-        {"merchantId": request.merchantId, "terminalId": request.terminalId}
-    ).sort("timestamp", -1).limit(5))
-
-    transaction_details = []
-    for transaction in transactions:
-        # Convert ObjectId to string for serialization
-        transaction['_id'] = str(transaction['_id'])
-        
-        # Create TransactionNotificationDetail object
-        detail = TransactionNotificationDetail(
-            mobileNumber=transaction['mobileNumber'],
-            merchantId=transaction['merchantId'],
-            terminalId=transaction['terminalId'],
-            retrievalReferenceNumber=transaction['retrievalReferenceNumber'],
-            amount=transaction['amount'],
-            remark1=transaction['remark1'],
-            type=transaction.get('type'),
-            uniqueId=transaction['uniqueId'],
-            properties=Properties(**transaction['properties']) if transaction.get('properties') else None
+
+def transaction_detail(transaction):
+    # Transactions were validated on write, so build the response without
+    # running the validators again
+    if transaction.get('properties'):
+        return TransactionNotificationDetail.model_construct(
+            **dict(transaction, properties=Properties.model_construct(**transaction['properties']))
         )
-        transaction_details.append(detail)
+    return TransactionNotificationDetail.model_construct(**transaction)
+
+@app.post("/callback", response_model=CallbackResponse)
+async def callback(request: CallbackRequest, authorized: bool = Depends(verify_hmac)):
+    logger.info("Received callback request for merchant: %s", request.merchantId)
+    await check_device(request.merchantId, request.terminalId)
+
+    # Retrieve the last 5 transactions from MongoDB
+    transactions = await db.recent_transactions(
+        request.merchantId, request.terminalId, limit=5,
+        projection=TRANSACTION_DETAIL_PROJECTION
+    )
+
+    response = CallbackResponse.model_construct(
+        transactionNotificationDetails=[transaction_detail(transaction) for transaction in transactions]
+    )
+    return Response(content=response.model_dump_json(), media_type="application/json")
 
-    return CallbackResponse(transactionNotificationDetails=transaction_details)
+def encode_cursor(transaction):
+    key = [transaction['timestamp'].isoformat(), str(transaction['_id'])]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        timestamp, transaction_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(timestamp), ObjectId(transaction_id)
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail={"message": "Invalid cursor", "code": "1"})
+
+async def history_lines(batches, limit):
+    count = 0
+    last = None
+    async for batch in batches:
+        count += len(batch)
+        last = batch[-1]
+        yield ''.join(transaction_detail(transaction).model_dump_json() + '\n' for transaction in batch)
+    # A full page may have more after it; a short one is the last
+    next_cursor = encode_cursor(last) if count == limit else None
+    yield json.dumps({"nextCursor": next_cursor}) + '\n'
+
+@app.post("/callback/history")
+async def callback_history(request: HistoryRequest, authorized: bool = Depends(verify_hmac)):
+    """
+    Transaction history of a terminal, newest first, streamed as NDJSON:
+    one transaction per line, then a `{"nextCursor": ...}` line. Send
+    nextCursor back as `cursor` for the next page; it is null on the last
+    page.
+    """
+    logger.info("Received history request for merchant: %s", request.merchantId)
+    await check_device(request.merchantId, request.terminalId)
+    after = decode_cursor(request.cursor) if request.cursor else None
+
+    limit = request.limit or HISTORY_PAGE_SIZE
+    batches = db.stream_transactions(
+        request.merchantId, request.terminalId,
+        after=after,
+        txn_from=request.fromDate,
+        txn_to=request.toDate,
+        limit=limit,
+        projection=HISTORY_PROJECTION,
+        batch_size=HISTORY_BATCH_SIZE
+    )
+    return StreamingResponse(history_lines(batches, limit), media_type="application/x-ndjson")
 
 @app.get("/")
 async def root():
-    return {"message": "Notification API for Acquirers is running"}
\ No newline at end of file
+    return {"message": "Notification API for Acquirers is running"}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
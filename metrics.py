@@ -0,0 +1,176 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Port of the standalone metrics endpoint of sender.py (0 disables it)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+
+# Default latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+class Metric:
+    """
+    Base of the metric families. Children per label value tuple are created
+    once and cached; after that, recording a sample does no formatting and
+    takes no lock. Samples are plain int and float adds, so two threads
+    racing on the same child can rarely lose an update.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self._child())
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self.children.items()):
+            lines.extend(child.render(self.name, _format_labels(self.labelnames, values)))
+        return lines
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, name, labels):
+        return [f'{name}_total{labels} {self.value}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'buckets', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        base = labels[1:-1] + ',' if labels else ''
+        for bound, bucket in zip(self.bounds + (math.inf,), self.buckets):
+            cumulative += bucket
+            le = '+Inf' if bound == math.inf else repr(float(bound))
+            lines.append(f'{name}_bucket{{{base}le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{labels} {self.sum}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+        return lines
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+class Gauge(Metric):
+    """
+    Gauge read at scrape time: `collect` returns either a number or a dict
+    of label value tuples to numbers, so the hot path records nothing.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        try:
+            samples = self.collect() if self.collect else {}
+        except Exception as e:
+            logger.error(f"Failed to collect {self.name}: {str(e)}")
+            samples = {}
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        for values, value in samples.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, values)} {value}')
+        return lines
+
+# All metrics of this process, in registration order
+registry = []
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+async def serve(port=METRICS_PORT, host='0.0.0.0'):
+    """
+    Minimal HTTP endpoint answering every request with the metrics, for
+    processes without a web framework (sender.py).
+    """
+    async def handle(reader, writer):
+        try:
+            # Skip the request line and headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            body = render().encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: ' + CONTENT_TYPE.encode()
+                + b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Serving metrics on port %s", port)
+    return server
+
+# Metrics shared by the API and the consumers
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ('path', 'status'))
+STAGE_LATENCY = Histogram('notification_stage_duration_seconds', 'Time spent per processing stage', ('stage',))
+PROVIDER_LATENCY = Histogram('provider_send_duration_seconds', 'Outbound provider call latency', ('provider',))
+PROVIDER_CALLS = Counter('provider_calls', 'Outbound provider calls by result', ('provider', 'result'))
+PROVIDER_SHED = Counter('provider_shed', 'Calls rejected by a circuit breaker or concurrency limit', ('provider',))
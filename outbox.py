@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+import metrics
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Outbox relay configuration
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 500))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1.0))
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 30))
+# Seconds between attempts to reach RabbitMQ when the relay starts
+OUTBOX_CONNECT_RETRY = float(os.getenv('OUTBOX_CONNECT_RETRY', 5))
+
+PUBLISH_STAGE = metrics.STAGE_LATENCY.labels('publish')
+RELAY_BATCH_SIZE = metrics.Histogram('outbox_batch_size', 'Notifications claimed per relay batch', buckets=metrics.SIZE_BUCKETS)
+RELAYED = metrics.Counter('outbox_relayed', 'Notifications published by the outbox relay by result', ('result',))
+
+def dispatch_record(data, message_id):
+    """
+    Pending-dispatch record stored in the transaction document itself, so
+    that the transaction and its notification are written atomically.
+    """
+    return {
+        "status": "pending",
+        "message": data,
+        "messageId": message_id
+    }
+
+class OutboxRelay:
+    """
+    Publishes the notifications of stored transactions. Pending dispatch
+    records are claimed in batches (the claim is a lease, so records of a
+    relay that died are picked up again), published with one round of
+    publisher confirms and marked as sent. Records that could not be
+    published go back to pending and are retried on the next poll, so a
+    broker outage delays notifications instead of dropping them.
+
+    The relay opens the dispatcher's publisher itself, retrying every
+    `connect_retry` seconds, so the API starts and accepts requests while
+    RabbitMQ is down; records stay pending until it can be reached.
+
+    The relay wakes up as soon as the transaction writer has flushed a
+    batch, and otherwise polls every `poll_interval` seconds. Several API
+    instances can run relays side by side; consumers drop the rare
+    duplicate by message id.
+    """
+
+    def __init__(self, db, dispatcher, batch_size=OUTBOX_BATCH_SIZE,
+                 poll_interval=OUTBOX_POLL_INTERVAL, lease=OUTBOX_LEASE, connect_retry=OUTBOX_CONNECT_RETRY):
+        self.db = db
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.connect_retry = connect_retry
+        self.wakeup = None
+        self.stopped = None
+        self.stopping = False
+        self.connected = False
+        self.task = None
+        self.relayed = 0
+        self.failed = 0
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.stopped = asyncio.Event()
+        self.stopping = False
+        self.connected = False
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Relay what is still pending and stop the background task. A relay
+        that never reached RabbitMQ leaves its records pending.
+        """
+        if self.task is None:
+            return
+        self.stopping = True
+        self.stopped.set()
+        self.wakeup.set()
+        if not self.connected:
+            # Do not wait for a connection attempt to time out
+            self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def _connect(self):
+        """
+        Start the dispatcher, retrying until RabbitMQ can be reached.
+        Returns False when the relay was stopped first.
+        """
+        while not self.stopping:
+            try:
+                await self.dispatcher.start()
+                return True
+            except Exception as e:
+                logger.error(f"Outbox relay cannot reach RabbitMQ, retrying in {self.connect_retry}s: {str(e)}")
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.connect_retry)
+            except asyncio.TimeoutError:
+                pass
+        return False
+
+    async def _run(self):
+        if not await self._connect():
+            return
+        self.connected = True
+        logger.info("Outbox relay connected")
+        while True:
+            # Stop only after a full pass that started once stop() was called
+            stopping = self.stopping
+            try:
+                # Keep going while full batches are published cleanly
+                while await self.relay_once() == self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"Outbox relay failed: {str(e)}")
+            if stopping:
+                break
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def relay_once(self):
+        """
+        Claim, publish and settle one batch. Returns the number of records
+        published, or -1 when part of the batch failed.
+        """
+        now = datetime.now()
+        claimed = await self.db.claim_dispatches(
+            uuid.uuid4().hex,
+            self.batch_size,
+            now,
+            now - timedelta(seconds=self.lease)
+        )
+        if not claimed:
+            return 0
+
+        started = time.perf_counter()
+        try:
+            results = await self.dispatcher.dispatch_many([
+                (document['dispatch']['message'], document['dispatch']['messageId']) for document in claimed
+            ])
+        except Exception:
+            await self.db.release_dispatches([document['_id'] for document in claimed])
+            raise
+        PUBLISH_STAGE.observe(time.perf_counter() - started)
+        RELAY_BATCH_SIZE.observe(len(claimed))
+        sent = [document['_id'] for document, success in zip(claimed, results) if success]
+        failed = [document['_id'] for document, success in zip(claimed, results) if not success]
+        if sent:
+            await self.db.mark_dispatched(sent, datetime.now())
+        if failed:
+            await self.db.release_dispatches(failed)
+            logger.error(f"Failed to publish {len(failed)} of {len(claimed)} notifications; will retry")
+
+        RELAYED.labels('success').inc(len(sent))
+        RELAYED.labels('failure').inc(len(failed))
+        self.relayed += len(sent)
+        self.failed += len(failed)
+        return -1 if failed else len(sent)
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import zlib
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Number of shard queues per work queue. 0 keeps the single, unpartitioned
+# queues. Changing it remaps merchants, so drain the old shards first.
+PARTITIONS = int(os.getenv('PARTITIONS', 0))
+
+def partition(merchant_id, partitions=PARTITIONS):
+    """
+    Shard of a merchant. crc32 is stable across processes and versions,
+    unlike hash().
+    """
+    return zlib.crc32(str(merchant_id).encode()) % partitions
+
+def shard_queue(queue_name, shard):
+    return f"{queue_name}.{shard}"
+
+def shard_queues(queue_names, partitions=PARTITIONS):
+    """
+    All shard queues of the given work queues, or the queues themselves
+    when partitioning is off.
+    """
+    if not partitions:
+        return list(queue_names)
+    return [shard_queue(queue_name, shard) for queue_name in queue_names for shard in range(partitions)]
+
+def base_queue(queue_name):
+    """
+    Work queue a shard queue belongs to, e.g. email_queue for email_queue.3.
+    """
+    return queue_name.split('.', 1)[0]
+
+def is_shard(queue_name):
+    return queue_name != base_queue(queue_name)
+
+def queue_arguments(queue_name):
+    """
+    Declaration arguments for a work queue. Shard queues allow a single
+    active consumer, so a shard is only ever consumed in one place even
+    while it is being handed over between workers.
+    """
+    if is_shard(queue_name):
+        return {'x-single-active-consumer': True}
+    return None
+
+def route_to_shards(queue_names, merchant_id, partitions=PARTITIONS):
+    if not partitions:
+        return list(queue_names)
+    shard = partition(merchant_id, partitions)
+    return [shard_queue(queue_name, shard) for queue_name in queue_names]
+
+def owner(queue_name, workers):
+    """
+    Rendezvous (highest random weight) hashing: every worker computes the
+    same owner for a shard from the same member list, and a worker joining
+    or leaving only moves the shards it wins or held.
+    """
+    return max(workers, key=lambda worker: hashlib.md5(f"{worker}/{queue_name}".encode()).digest())
+
+def assign(queue_names, workers, worker_id):
+    """
+    Shard queues owned by `worker_id` among `workers`.
+    """
+    if not workers:
+        return []
+    return [queue_name for queue_name in queue_names if owner(queue_name, workers) == worker_id]
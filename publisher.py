@@ -0,0 +1,157 @@
+import aio_pika
+import asyncio
+import itertools
+import logging
+import os
+import time
+import partitions
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# RabbitMQ Server Configuration
+RABBITMQ_SERVER = os.getenv('RABBITMQ_SERVER', 'localhost')
+RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', 5672))
+RABBITMQ_USER = os.getenv('RABBITMQ_USER', 'guest')
+RABBITMQ_PASS = os.getenv('RABBITMQ_PASS', 'guest')
+RABBITMQ_VHOST = "/"
+
+# Pool sizing
+PUBLISHER_CONNECTIONS = int(os.getenv('PUBLISHER_CONNECTIONS', 1))
+PUBLISHER_CHANNELS = int(os.getenv('PUBLISHER_CHANNELS', 4))
+
+class PublisherStats:
+    """
+    Counters for published messages and publisher confirm latency.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.published = 0
+        self.failed = 0
+        self.batches = 0
+        self.confirm_time = 0.0
+        self.confirm_max = 0.0
+
+    def record_batch(self, size, elapsed, failed=0):
+        self.batches += 1
+        self.published += size - failed
+        self.failed += failed
+        self.confirm_time += elapsed
+        self.confirm_max = max(self.confirm_max, elapsed)
+
+    def snapshot(self):
+        uptime = time.monotonic() - self.started
+        return {
+            'published': self.published,
+            'failed': self.failed,
+            'batches': self.batches,
+            'throughput': self.published / uptime if uptime else 0.0,
+            'confirm_latency_avg': self.confirm_time / self.batches if self.batches else 0.0,
+            'confirm_latency_max': self.confirm_max
+        }
+
+class PublisherPool:
+    """
+    Reusable RabbitMQ publisher. Keeps a pool of connections, each with a
+    set of channels in publisher-confirm mode. Queues are declared once per
+    pool, and a batch of messages is published before waiting for all of
+    its confirms together, so durability costs one round trip per batch
+    rather than one per message. Queues are durable and messages
+    persistent, so a confirmed message survives a broker restart.
+    """
+
+    def __init__(self, connections=PUBLISHER_CONNECTIONS, channels=PUBLISHER_CHANNELS,
+                 host=RABBITMQ_SERVER, port=RABBITMQ_PORT):
+        self.size = connections
+        self.channels_per_connection = channels
+        self.host = host
+        self.port = port
+        self.connections = []
+        self.channels = []
+        self.declared = set()
+        self.stats = PublisherStats()
+        self._next_channel = None
+        self._declare_lock = asyncio.Lock()
+
+    async def start(self):
+        try:
+            for _ in range(self.size):
+                connection = await aio_pika.connect_robust(
+                    host=self.host,
+                    port=self.port,
+                    login=RABBITMQ_USER,
+                    password=RABBITMQ_PASS,
+                    virtualhost=RABBITMQ_VHOST
+                )
+                self.connections.append(connection)
+                for _ in range(self.channels_per_connection):
+                    self.channels.append(await connection.channel(publisher_confirms=True))
+        except BaseException:
+            # Close what was opened, so that start() can be retried
+            await self.stop()
+            raise
+        self._next_channel = itertools.cycle(self.channels)
+        logger.info("Publisher pool connected to %s with %s channels", self.host, len(self.channels))
+
+    async def stop(self):
+        for connection in self.connections:
+            await connection.close()
+        self.connections.clear()
+        self.channels.clear()
+        self.declared.clear()
+
+    async def declare(self, queue_names):
+        """
+        Declare queues that have not been declared by this pool yet.
+        """
+        async with self._declare_lock:
+            channel = self.channels[0]
+            for queue_name in queue_names:
+                if queue_name not in self.declared:
+                    await channel.declare_queue(
+                        queue_name,
+                        durable=True,
+                        arguments=partitions.queue_arguments(queue_name)
+                    )
+                    self.declared.add(queue_name)
+
+    async def publish(self, queue_name, body, **properties):
+        await self.publish_batch([(queue_name, body)], **properties)
+
+    async def publish_batch(self, messages, **properties):
+        """
+        Publish a list of (queue_name, body) pairs and wait for all of their
+        confirms at once. Raises the first failure after the whole batch has
+        been confirmed or rejected.
+        """
+        results = await self.publish_many([(queue_name, body, properties) for queue_name, body in messages])
+        failures = [result for result in results if result is not None]
+        if failures:
+            raise failures[0]
+
+    async def publish_many(self, messages):
+        """
+        Publish a list of (queue_name, body, properties) messages and wait
+        for all of their confirms at once. Returns None for each confirmed
+        message and the exception for each failed one.
+        """
+        if not messages:
+            return []
+        await self.declare({queue_name for queue_name, _, _ in messages})
+
+        channel = next(self._next_channel)
+        started = time.monotonic()
+        results = await asyncio.gather(*[
+            channel.default_exchange.publish(
+                aio_pika.Message(body=body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT, **properties),
+                routing_key=queue_name
+            )
+            for queue_name, body, properties in messages
+        ], return_exceptions=True)
+        results = [result if isinstance(result, Exception) else None for result in results]
+        failed = len(messages) - results.count(None)
+        self.stats.record_batch(len(messages), time.monotonic() - started, failed)
+        return results
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import metrics
+from collections import Counter, OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Token buckets in front of the notification endpoints: the sustained rate
+# in requests per second (0 disables the bucket) and the burst allowed on
+# top of it, per merchant/terminal and per destination mobile number
+TERMINAL_RATE_LIMIT = float(os.getenv('TERMINAL_RATE_LIMIT', 10))
+TERMINAL_BURST = float(os.getenv('TERMINAL_BURST', 50))
+MOBILE_RATE_LIMIT = float(os.getenv('MOBILE_RATE_LIMIT', 1))
+MOBILE_BURST = float(os.getenv('MOBILE_BURST', 20))
+# Items of /notification/bulk take from a per-terminal bucket of their own
+# instead of the terminal one, so a backfill is not held to the rate of
+# single requests (nor starves them); the mobile bucket applies to both
+BULK_TERMINAL_RATE_LIMIT = float(os.getenv('BULK_TERMINAL_RATE_LIMIT', 100))
+BULK_TERMINAL_BURST = float(os.getenv('BULK_TERMINAL_BURST', 1000))
+# memory keeps the buckets per process; mongodb shares them between all
+# API processes at the cost of a round trip per request
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_CACHE_SIZE = int(os.getenv('RATE_LIMIT_CACHE_SIZE', 100000))
+
+RATE_LIMITED = metrics.Counter('rate_limited', 'Notification requests refused by a rate limit', ('limit',))
+
+class MemoryBuckets:
+    """
+    Token buckets of this process. Beyond `size` buckets the least recently
+    used are forgotten; a forgotten bucket starts out full again.
+    """
+
+    def __init__(self, size=RATE_LIMIT_CACHE_SIZE):
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def start(self):
+        pass
+
+    async def take(self, requests, now=None):
+        """
+        Take up to `count` tokens from each (bucket, rate, capacity, count).
+        Returns the tokens granted and left, per request.
+        """
+        now = time.monotonic() if now is None else now
+        results = []
+        with self.lock:
+            for bucket, rate, capacity, count in requests:
+                tokens, updated = self.buckets.pop(bucket, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                granted = min(count, max(0, int(tokens)))
+                self.buckets[bucket] = (tokens - granted, now)
+                results.append((granted, tokens - granted))
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return results
+
+    async def refund(self, requests):
+        """
+        Put back `count` unused tokens into each (bucket, capacity, count).
+        """
+        with self.lock:
+            for bucket, capacity, count in requests:
+                if bucket in self.buckets:
+                    tokens, updated = self.buckets[bucket]
+                    self.buckets[bucket] = (min(capacity, tokens + count), updated)
+
+class MongoBuckets:
+    """
+    Token buckets in the `rate-limits` collection, shared by every API
+    process. Each bucket is refilled and taken from in one atomic update
+    against the database clock, and expires once it would be full again.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    async def start(self):
+        await self.db.ensure_rate_limit_index()
+
+    async def take(self, requests):
+        return await asyncio.gather(*(
+            self.db.take_tokens(bucket, rate, capacity, count) for bucket, rate, capacity, count in requests
+        ))
+
+    async def refund(self, requests):
+        await asyncio.gather(*(
+            self.db.refund_tokens(bucket, capacity, count) for bucket, capacity, count in requests
+        ))
+
+class RequestLimiter:
+    """
+    Sheds notification requests of a merchant/terminal or to a mobile
+    number that exceed their token bucket, before anything is stored or
+    published. A request takes a token from both of its buckets or from
+    neither. When the shared backend cannot be reached, requests are let
+    through rather than refused.
+    """
+
+    def __init__(self, db=None, backend=RATE_LIMIT_BACKEND,
+                 terminal=(TERMINAL_RATE_LIMIT, TERMINAL_BURST), mobile=(MOBILE_RATE_LIMIT, MOBILE_BURST),
+                 bulk=(BULK_TERMINAL_RATE_LIMIT, BULK_TERMINAL_BURST)):
+        if backend == 'memory':
+            self.buckets = MemoryBuckets()
+        elif backend == 'mongodb':
+            self.buckets = MongoBuckets(db)
+        else:
+            raise ValueError(f"Unknown rate limit backend: {backend}")
+        # Per limit: rate and capacity, the latter at least one token
+        self.limits = {
+            name: (rate, max(1, burst))
+            for name, (rate, burst) in (('terminal', terminal), ('mobile', mobile), ('bulk', bulk))
+            if rate > 0
+        }
+        self.limited = 0
+
+    async def start(self):
+        if self.limits:
+            await self.buckets.start()
+
+    def _buckets(self, merchant_id, terminal_id, mobile_number, bulk=False):
+        keys = {'bulk' if bulk else 'terminal': f"{merchant_id}:{terminal_id}", 'mobile': mobile_number}
+        return [(name, f"{name}:{key}") for name, key in keys.items() if name in self.limits]
+
+    async def acquire(self, merchant_id, terminal_id, mobile_number):
+        """
+        Returns None when the request may go ahead, otherwise the name of
+        the exceeded limit and the seconds until a token is available.
+        """
+        return (await self.acquire_many([(merchant_id, terminal_id, mobile_number)]))[0]
+
+    async def acquire_many(self, requests, bulk=False):
+        """
+        acquire() for a batch of (merchantId, terminalId, mobileNumber), in
+        order, with one take per distinct bucket. Bulk items take from the
+        bulk bucket of their terminal.
+        """
+        wanted = [self._buckets(*request, bulk=bulk) for request in requests]
+        if not any(wanted):
+            return [None] * len(requests)
+        counts = Counter(bucket for buckets in wanted for bucket in buckets)
+        try:
+            taken = await self.buckets.take([
+                (bucket, *self.limits[name], count) for (name, bucket), count in counts.items()
+            ])
+        except Exception as e:
+            logger.error(f"Rate limiter unavailable, letting requests through: {str(e)}")
+            return [None] * len(requests)
+        available = {key: granted for key, (granted, _) in zip(counts, taken)}
+        left = {key: tokens for key, (_, tokens) in zip(counts, taken)}
+
+        results = []
+        for buckets in wanted:
+            # Buckets a request found empty have less than a token left
+            waits = [((1 - left[key]) / self.limits[key[0]][0], key[0]) for key in buckets if not available[key]]
+            if waits:
+                retry_after, name = max(waits)
+                results.append((name, retry_after))
+                RATE_LIMITED.labels(name).inc()
+                continue
+            for key in buckets:
+                available[key] -= 1
+            results.append(None)
+
+        # Tokens granted to requests refused by their other bucket
+        unused = [(bucket, self.limits[name][1], count) for (name, bucket), count in available.items() if count]
+        if unused:
+            try:
+                await self.buckets.refund(unused)
+            except Exception as e:
+                logger.error(f"Failed to return unused rate limit tokens: {str(e)}")
+
+        limited = len(results) - results.count(None)
+        if limited:
+            self.limited += limited
+            logger.warning("Rate limited %s of %s notification requests", limited, len(requests))
+        return results
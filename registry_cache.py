@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Registry cache configuration
+REGISTRY_CACHE_SIZE = int(os.getenv('REGISTRY_CACHE_SIZE', 100000))
+REGISTRY_CACHE_TTL = float(os.getenv('REGISTRY_CACHE_TTL', 300))
+REGISTRY_NEGATIVE_TTL = float(os.getenv('REGISTRY_NEGATIVE_TTL', 30))
+# none, change_stream or poll
+REGISTRY_INVALIDATION = os.getenv('REGISTRY_INVALIDATION', 'none')
+REGISTRY_POLL_INTERVAL = float(os.getenv('REGISTRY_POLL_INTERVAL', 10))
+
+MISSING = object()
+
+class RegistryCache:
+    """
+    In-memory cache of merchant-registry documents keyed by
+    (merchantId, terminalId), with a merchantId-only key used for merchant
+    existence checks. Bounded in size with LRU eviction, entries expire
+    after a TTL, and unknown devices are cached for a shorter negative TTL.
+    Concurrent misses for the same key share a single database lookup.
+
+    Invalidation is optional: `change_stream` watches the registry
+    collection (requires a replica set), `poll` clears the cache whenever
+    the registry version stamp changes.
+    """
+
+    def __init__(self, db, max_size=REGISTRY_CACHE_SIZE, ttl=REGISTRY_CACHE_TTL,
+                 negative_ttl=REGISTRY_NEGATIVE_TTL, invalidation=REGISTRY_INVALIDATION,
+                 poll_interval=REGISTRY_POLL_INTERVAL):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.invalidation = invalidation
+        self.poll_interval = poll_interval
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    async def start(self):
+        if self.invalidation == 'change_stream':
+            self.task = asyncio.create_task(self._watch())
+        elif self.invalidation == 'poll':
+            self.task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def get_device(self, merchant_id, terminal_id):
+        return await self._lookup(
+            (merchant_id, terminal_id),
+            lambda: self.db.find_device(merchant_id, terminal_id)
+        )
+
+    async def get_merchant(self, merchant_id):
+        return await self._lookup(
+            (merchant_id, None),
+            lambda: self.db.find_merchant(merchant_id)
+        )
+
+    async def get_devices(self, keys):
+        """
+        Look up many (merchantId, terminalId) pairs at once: cached entries
+        are answered from memory and all misses are loaded with one query.
+        Returns a dict of pair to device, None for unknown devices.
+        """
+        devices = {}
+        missing = []
+        now = time.monotonic()
+        for key in set(keys):
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= now:
+                missing.append(key)
+                continue
+            self.entries.move_to_end(key)
+            if entry[0] is MISSING:
+                self.negative_hits += 1
+                devices[key] = None
+            else:
+                self.hits += 1
+                devices[key] = entry[0]
+
+        if missing:
+            self.misses += len(missing)
+            found = await self.db.find_devices(missing)
+            for key in missing:
+                devices[key] = found.get(key)
+                self._store(key, devices[key])
+        return devices
+
+    async def _lookup(self, key, load):
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                if value is MISSING:
+                    self.negative_hits += 1
+                    return None
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        self.misses += 1
+        future = self.pending.get(key)
+        if future is not None:
+            return await future
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            value = await load()
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else is waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            self._store(key, value)
+            return value
+        finally:
+            del self.pending[key]
+
+    def _store(self, key, value):
+        if value is None:
+            self.entries[key] = (MISSING, time.monotonic() + self.negative_ttl)
+        else:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, merchant_id=None, terminal_id=None):
+        """
+        Drop cached entries for a device and its merchant, or everything
+        when no merchantId is given.
+        """
+        if merchant_id is None:
+            self.entries.clear()
+            return
+        self.entries.pop((merchant_id, terminal_id), None)
+        self.entries.pop((merchant_id, None), None)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'evictions': self.evictions
+        }
+
+    async def _watch(self):
+        while True:
+            try:
+                async with self.db.watch_registry() as stream:
+                    # Anything may have changed while the stream was down
+                    self.invalidate()
+                    async for change in stream:
+                        # An insert only affects its own (possibly negative) entries;
+                        # updates and deletes may have moved or removed any key.
+                        fonepay = (change.get('fullDocument') or {}).get('fonepay') or {}
+                        if change['operationType'] == 'insert' and fonepay.get('merchantId'):
+                            self.invalidate(fonepay['merchantId'], fonepay.get('terminalId'))
+                        else:
+                            self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Registry change stream failed: {str(e)}. Retrying in 5 seconds...")
+                await asyncio.sleep(5)
+
+    async def _poll(self):
+        version = None
+        while True:
+            try:
+                current = await self.db.registry_version()
+                if current != version:
+                    if version is not None:
+                        logger.info("Registry version changed to %s, clearing cache", current)
+                    self.invalidate()
+                    version = current
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error polling registry version: {str(e)}")
+            await asyncio.sleep(self.poll_interval)
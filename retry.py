@@ -0,0 +1,161 @@
+import aio_pika
+import argparse
+import logging
+import os
+import random
+import pika
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Retry configuration
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 5))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 5))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 3600))
+RETRY_JITTER = float(os.getenv('RETRY_JITTER', 0.2))
+
+ATTEMPT_HEADER = 'x-attempt'
+
+def retry_delay(attempt):
+    """
+    Backoff before the given retry attempt (1-based), in milliseconds.
+    """
+    return int(min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY) * 1000)
+
+def retry_queue(queue_name, attempt):
+    # The delay is part of the name, so changing the backoff settings
+    # declares new queues instead of clashing with the old arguments
+    return f"{queue_name}.retry.{retry_delay(attempt)}"
+
+def dead_letter_queue(queue_name):
+    return f"{queue_name}.dlq"
+
+def retry_arguments(queue_name, attempt):
+    return {
+        'x-message-ttl': retry_delay(attempt),
+        'x-dead-letter-exchange': '',
+        'x-dead-letter-routing-key': queue_name
+    }
+
+def declare(channel, queue_name):
+    """
+    Declare the delayed retry queues and the final dead-letter queue for a
+    work queue. Messages wait in a retry queue until their TTL expires and
+    are then dead-lettered back onto the work queue.
+    """
+    for attempt in range(1, RETRY_MAX_ATTEMPTS):
+        channel.queue_declare(
+            queue=retry_queue(queue_name, attempt),
+            durable=True,
+            arguments=retry_arguments(queue_name, attempt)
+        )
+    channel.queue_declare(queue=dead_letter_queue(queue_name), durable=True)
+
+async def declare_async(channel, queue_name):
+    """
+    declare() for an aio-pika channel.
+    """
+    for attempt in range(1, RETRY_MAX_ATTEMPTS):
+        await channel.declare_queue(
+            retry_queue(queue_name, attempt),
+            durable=True,
+            arguments=retry_arguments(queue_name, attempt)
+        )
+    await channel.declare_queue(dead_letter_queue(queue_name), durable=True)
+
+def attempts(properties):
+    headers = (properties.headers if properties else None) or {}
+    return headers.get(ATTEMPT_HEADER, 0)
+
+def next_attempt(queue_name, properties, final=False):
+    """
+    Work out where a failed message goes next. Returns the destination
+    queue, the message headers and the expiration in milliseconds (None for
+    the dead-letter queue).
+    """
+    attempt = attempts(properties) + 1
+    headers = dict((properties.headers if properties else None) or {})
+    headers[ATTEMPT_HEADER] = attempt
+
+    if final or attempt >= RETRY_MAX_ATTEMPTS:
+        return dead_letter_queue(queue_name), headers, None
+    # Jitter within the tier; the queue TTL still caps the wait
+    jitter = 1 - random.uniform(0, RETRY_JITTER)
+    return retry_queue(queue_name, attempt), headers, int(retry_delay(attempt) * jitter)
+
+def schedule_retry(channel, queue_name, body, properties, final=False):
+    """
+    Republish a failed message to its next retry queue, or to the
+    dead-letter queue once it is out of attempts (or `final` is set for
+    messages that can never succeed). Returns the destination queue.
+    """
+    destination, headers, expiration = next_attempt(queue_name, properties, final)
+    retry_properties = pika.BasicProperties(
+        content_type=properties.content_type if properties else None,
+        message_id=properties.message_id if properties else None,
+        headers=headers,
+        delivery_mode=pika.DeliveryMode.Persistent,
+        expiration=str(expiration) if expiration is not None else None
+    )
+
+    channel.basic_publish(exchange='', routing_key=destination, body=body, properties=retry_properties)
+    logger.info("Scheduled attempt %s of message from %s on %s", headers[ATTEMPT_HEADER], queue_name, destination)
+    return destination
+
+async def schedule_retry_async(channel, queue_name, message, final=False):
+    """
+    schedule_retry() for an aio-pika channel and incoming message; waits
+    for the publisher confirm.
+    """
+    destination, headers, expiration = next_attempt(queue_name, message, final)
+    await channel.default_exchange.publish(
+        aio_pika.Message(
+            body=message.body,
+            content_type=message.content_type,
+            message_id=message.message_id,
+            headers=headers,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            expiration=expiration / 1000 if expiration is not None else None
+        ),
+        routing_key=destination
+    )
+    logger.info("Scheduled attempt %s of message from %s on %s", headers[ATTEMPT_HEADER], queue_name, destination)
+    return destination
+
+def replay(channel, queue_name, limit=None):
+    """
+    Move messages from a queue's dead-letter queue back onto the queue,
+    with a fresh attempt count. Returns the number of messages replayed.
+    """
+    replayed = 0
+    while limit is None or replayed < limit:
+        method, properties, body = channel.basic_get(queue=dead_letter_queue(queue_name))
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        headers.pop(ATTEMPT_HEADER, None)
+        properties.headers = headers
+        channel.basic_publish(exchange='', routing_key=queue_name, body=body, properties=properties)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+    return replayed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay dead-lettered notifications")
+    parser.add_argument('command', choices=['replay'])
+    parser.add_argument('queue', help="work queue, e.g. email_queue")
+    parser.add_argument('--limit', type=int, default=None, help="replay at most this many messages")
+    args = parser.parse_args()
+
+    from sender import create_channel
+
+    connection, channel = create_channel()
+    channel.confirm_delivery()
+    try:
+        print(f"Replayed {replay(channel, args.queue, args.limit)} messages onto {args.queue}")
+    finally:
+        connection.close()
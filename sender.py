@@ -1,12 +1,20 @@
-import pika
-import json
+import aio_pika
+import argparse
+import asyncio
 import logging
-import threading
-import time
-import subprocess
-import sys
+import multiprocessing
 import os
-from email_sender import email_alert, sms_alert
+import signal
+import pika
+import time
+import codec
+import metrics
+import partitions
+import retry
+from dispatcher import QUEUES
+from idempotency import LRUSet
+from email_sender import email_alerts, sms_alerts
+from koili_ipn import IPNClient
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,108 +29,432 @@ logging.getLogger("pika").setLevel(logging.WARNING)
 # Constants
 BATCH_SIZE = 100
 BATCH_TIMEOUT = 5
+DELIVERED_CACHE_SIZE = int(os.getenv('DELIVERED_CACHE_SIZE', 100000))
+
+# Runtime configuration. Concurrency is the number of batches in flight per
+# queue and can be set per queue, e.g. EMAIL_QUEUE_CONCURRENCY=8. Shard
+# queues default to one batch at a time to keep per-merchant order.
+CONSUMER_CONCURRENCY = int(os.getenv('CONSUMER_CONCURRENCY', 4))
+PARTITION_CONCURRENCY = int(os.getenv('PARTITION_CONCURRENCY', 1))
+CONSUMER_PROCESSES = int(os.getenv('CONSUMER_PROCESSES', 1))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 30))
+# Unacknowledged messages per queue; 0 sizes it to the batches in flight
+PREFETCH_COUNT = int(os.getenv('PREFETCH_COUNT', 0))
+
+# Seconds between broker queue depth samples for the metrics
+QUEUE_DEPTH_INTERVAL = float(os.getenv('QUEUE_DEPTH_INTERVAL', 15))
 
 # Remote RabbitMQ Server Configuration
-RABBITMQ_SERVER = os.getenv('RABBITMQ_SERVER')
-RABBITMQ_PORT = os.getenv('RABBITMQ_PORT')
-RABBITMQ_USER = os.getenv('RABBITMQ_USER')
-RABBITMQ_PASS = os.getenv('RABBITMQ_PASS')
+RABBITMQ_SERVER = os.getenv('RABBITMQ_SERVER', 'localhost')
+RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', 5672))
+RABBITMQ_USER = os.getenv('RABBITMQ_USER', 'guest')
+RABBITMQ_PASS = os.getenv('RABBITMQ_PASS', 'guest')
 RABBITMQ_VHOST = "/"
 
-# Global variables
-message_batches = {
-    'koili_ipn_queue': [],
-    'email_queue': [],
-    'sms_queue': []
-}
-
-batch_locks = {
-    'koili_ipn_queue': threading.Lock(),
-    'email_queue': threading.Lock(),
-    'sms_queue': threading.Lock()
-}
-
-def run_koili_ipn(amount, machine_identifier):
-    script_path = os.path.join(os.path.dirname(__file__), 'koili_ipn.py')
-    
-    args = [
-        sys.executable,
-        script_path,
-        str(amount),
-        machine_identifier
-    ]
-    
+BATCH_SIZES = metrics.Histogram('consumer_batch_size', 'Messages per processed batch', ('queue',), buckets=metrics.SIZE_BUCKETS)
+BATCH_LATENCY = metrics.Histogram('consumer_batch_duration_seconds', 'Time to send a batch', ('queue',))
+MESSAGES = metrics.Counter('consumer_messages', 'Consumed messages by outcome', ('queue', 'outcome'))
+
+# Runtimes of this process, for the metrics
+runtimes = []
+
+def consumer_samples(read):
+    return {
+        (queue_name,): read(consumer)
+        for runtime in runtimes for queue_name, consumer in list(runtime.consumers.items())
+    }
+
+metrics.Gauge('consumer_pending', 'Messages received but not yet batched', ('queue',),
+              collect=lambda: consumer_samples(lambda consumer: len(consumer.pending)))
+metrics.Gauge('consumer_inflight_batches', 'Batches being sent', ('queue',),
+              collect=lambda: consumer_samples(lambda consumer: len(consumer.tasks)))
+metrics.Gauge('queue_depth', 'Messages ready in the broker queue (sampled)', ('queue',),
+              collect=lambda: consumer_samples(lambda consumer: consumer.depth))
+
+# Message ids recently sent from each queue, to drop broker redeliveries.
+# Only successes are recorded so that retried messages still go through.
+delivered = {queue_name: LRUSet(DELIVERED_CACHE_SIZE) for queue_name in QUEUES}
+
+def queue_concurrency(queue_name):
+    if partitions.is_shard(queue_name):
+        return PARTITION_CONCURRENCY
+    return int(os.getenv(f'{queue_name.upper()}_CONCURRENCY', CONSUMER_CONCURRENCY))
+
+def parse_message(queue_name, body, properties=None):
+    """
+    Decode a queued notification into the arguments of its transport.
+    Returns None when the message cannot be processed.
+    """
     try:
-        subprocess.Popen(args)
+        data = codec.decode_message(body, properties)
+
+        if queue_name == 'koili_ipn_queue':
+            # An amount float() rejects can never be sent; dead-letter it
+            # now instead of retrying it
+            return float(data['amount']), data['machineIdentifier']
+        elif queue_name == 'email_queue':
+            subject = f"Payment Confirmation - {data['merchantId']}"
+            email_body = f"""
+            Dear Merchant,
+
+            A payment of Rs{data['amount']} has been received from {data['mobileNumber']}.
+            Commission: Rs{data.get('commission', 'N/A')}
+
+            Thank you for using our payment system.
+            """
+            return subject, email_body, data['email']
+        elif queue_name == 'sms_queue':
+            sms_body = f"Payment of Rs{data['amount']} received for merchant {data['merchantId']}"
+            return sms_body, data['mobileNumber']
+    except ValueError as e:
+        logger.error(f"Error decoding message from {queue_name}: {str(e)}")
+        logger.error(f"Raw message: {body}")
+    except KeyError as e:
+        logger.error(f"Missing key in message from {queue_name}: {str(e)}")
+        logger.error(f"Message content: {data}")
     except Exception as e:
-        logger.error(f"Error launching koili_ipn script: {str(e)}")
+        logger.error(f"Error processing message from {queue_name}: {str(e)}")
+        logger.error(f"Raw message: {body}")
+    return None
+
+def blocking(send_batch):
+    """
+    Run a blocking batch transport on the default executor.
+    """
+    async def send(requests):
+        return await asyncio.get_running_loop().run_in_executor(None, send_batch, requests)
+    return send
+
+async def process_messages(queue_name, messages, send_batch):
+    """
+    Send a batch of incoming messages through the queue's transport and
+    return an outcome per message: True when sent, False when it failed and
+    may be retried, None when it cannot be processed. `queue_name` is the
+    work queue, also for messages consumed from one of its shards.
+    """
+    logger.info("Processing %s messages from %s", len(messages), queue_name)
+    started = time.perf_counter()
+    outcomes = [None] * len(messages)
+    indexes = []
+    requests = []
+    for index, message in enumerate(messages):
+        if message.message_id and message.message_id in delivered[queue_name]:
+            # Redelivery of a message that was already sent
+            logger.info("Skipping duplicate message %s from %s", message.message_id, queue_name)
+            MESSAGES.labels(queue_name, 'duplicate').inc()
+            outcomes[index] = True
+            continue
+        request = parse_message(queue_name, message.body, message)
+        if request is not None:
+            indexes.append(index)
+            requests.append(request)
 
-def process_messages(queue_name, messages):
-    logger.info(f"Processing {len(messages)} messages from {queue_name}")
-    for method, body in messages:
+    if requests:
         try:
-            message_str = body.decode('utf-8')
-            data = json.loads(message_str)
-            
-            if queue_name == 'koili_ipn_queue':
-                 logger.info(f"Attempting to process koili_ipn for amount: {data['amount']} and machine_identifier: {data['machineIdentifier']}")
-                 run_koili_ipn(data['amount'], data['machineIdentifier'])
-                 logger.info(f"Finished processing koili_ipn for amount: {data['amount']}")
-            elif queue_name == 'email_queue':
-                subject = f"Payment Confirmation - {data['merchantId']}"
-                body = f"""
-                Dear Merchant,
-
-                A payment of Rs{data['amount']} has been received from {data['mobileNumber']}.
-                Commission: Rs{data.get('commission', 'N/A')}
-
-                Thank you for using our payment system.
-                """
-                email_alert(subject, body, data['email'])
-                logger.info(f"Sent email for merchant: {data['merchantId']}")
-            elif queue_name == 'sms_queue':
-                sms_body = f"Payment of Rs{data['amount']} received for merchant {data['merchantId']}"
-                sms_alert(sms_body, data['mobileNumber'])
-                logger.info(f"Sent SMS to mobile: {data['mobileNumber']}")
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decoding JSON from {queue_name}: {str(e)}")
-            logger.error(f"Raw message: {message_str}")
-        except KeyError as e:
-            logger.error(f"Missing key in message from {queue_name}: {str(e)}")
-            logger.error(f"Message content: {data}")
+            results = await send_batch(requests)
         except Exception as e:
-            logger.error(f"Error processing message from {queue_name}: {str(e)}")
-            logger.error(f"Raw message: {body}")
-
-def process_batch(channel, queue_name):
-    global message_batches
-    with batch_locks[queue_name]:
-        if message_batches[queue_name]:
-            process_messages(queue_name, message_batches[queue_name])
-            for method, _ in message_batches[queue_name]:
+            logger.error(f"Error processing batch from {queue_name}: {str(e)}")
+            results = [False] * len(requests)
+        for index, success in zip(indexes, results):
+            outcomes[index] = success
+            message_id = messages[index].message_id
+            if success and message_id:
+                delivered[queue_name].add(message_id)
+
+    sent = outcomes.count(True)
+    invalid = outcomes.count(None)
+    BATCH_SIZES.labels(queue_name).observe(len(messages))
+    BATCH_LATENCY.labels(queue_name).observe(time.perf_counter() - started)
+    MESSAGES.labels(queue_name, 'sent').inc(sent)
+    MESSAGES.labels(queue_name, 'failed').inc(len(messages) - sent - invalid)
+    MESSAGES.labels(queue_name, 'invalid').inc(invalid)
+    logger.info("Processed %s of %s messages from %s", sent, len(messages), queue_name)
+    return list(zip(messages, outcomes))
+
+class RangeAcker:
+    """
+    Acknowledges settled deliveries of one channel in contiguous ranges
+    with a single multiple=True ack, so that batches settling out of order
+    never ack a message that is still in flight.
+    """
+
+    def __init__(self):
+        self.channel = None
+        self.acked = 0
+        self.settled = {}
+
+    def track(self, message):
+        if message.channel is not self.channel:
+            # A reopened channel numbers its deliveries from 1 again; the
+            # old channel's unacked messages are redelivered by the broker
+            self.channel = message.channel
+            self.acked = message.delivery_tag - 1
+            self.settled = {}
+
+    async def settle(self, messages, acked=True):
+        """
+        Mark messages as settled. Messages that were already nacked are
+        passed with acked=False so the range ack stops short of them.
+        """
+        for message in messages:
+            if message.channel is self.channel:
+                self.settled[message.delivery_tag] = message if acked else None
+        last = None
+        while self.acked + 1 in self.settled:
+            self.acked += 1
+            last = self.settled.pop(self.acked) or last
+        if last is not None:
+            await last.ack(multiple=True)
+
+class QueueConsumer:
+    """
+    Consumes one queue on its own channel. Messages are collected into
+    batches of BATCH_SIZE (or whatever arrived within BATCH_TIMEOUT) and up
+    to `concurrency` batches are sent at the same time.
+    """
+
+    def __init__(self, connection, queue_name, send_batch, concurrency=None):
+        self.connection = connection
+        self.queue_name = queue_name
+        self.work_queue = partitions.base_queue(queue_name)
+        self.send_batch = send_batch
+        self.concurrency = concurrency or queue_concurrency(queue_name)
+        self.prefetch = PREFETCH_COUNT or (self.concurrency + 1) * BATCH_SIZE
+        self.pending = []
+        self.ready = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.tasks = set()
+        self.acker = RangeAcker()
+        self.channel = None
+        self.queue = None
+        self.consumer_tag = None
+        self.depth = 0
+
+    async def start(self):
+        self.channel = await self.connection.channel(publisher_confirms=True)
+        await self.channel.set_qos(prefetch_count=self.prefetch)
+        self.queue = await self.channel.declare_queue(
+            self.queue_name,
+            durable=True,
+            arguments=partitions.queue_arguments(self.queue_name)
+        )
+        await retry.declare_async(self.channel, self.queue_name)
+        self.consumer_tag = await self.queue.consume(self.on_message)
+        logger.info("Started consuming from %s", self.queue_name)
+
+    async def on_message(self, message):
+        self.acker.track(message)
+        self.pending.append(message)
+        if len(self.pending) >= BATCH_SIZE:
+            self.ready.set()
+
+    async def run(self):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.ready.wait(), BATCH_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            self.ready.clear()
+            await self.flush()
+
+    def stop(self):
+        self.stopping.set()
+        self.ready.set()
+
+    async def flush(self):
+        batch, self.pending = self.pending[:BATCH_SIZE], self.pending[BATCH_SIZE:]
+        if len(self.pending) >= BATCH_SIZE:
+            self.ready.set()
+        if not batch:
+            return
+        await self.slots.acquire()
+        task = asyncio.ensure_future(self.handle(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, batch):
+        try:
+            outcomes = await process_messages(self.work_queue, batch, self.send_batch)
+            await self.settle(outcomes)
+        except Exception as e:
+            # Unsettled messages are redelivered when the channel closes
+            logger.error(f"Failed to settle messages from {self.queue_name}: {str(e)}")
+        finally:
+            self.slots.release()
+
+    async def settle(self, outcomes):
+        """
+        Republish failed messages to their retry queue (or the dead-letter
+        queue), then range-ack the batch.
+        """
+        nacked = set()
+        for message, success in outcomes:
+            if success:
+                continue
+            try:
+                await retry.schedule_retry_async(self.channel, self.queue_name, message, final=success is None)
+            except Exception as e:
+                logger.warning("Failed to schedule retry for a message from %s: %s", self.queue_name, e)
+                await message.nack(requeue=True)
+                nacked.add(message.delivery_tag)
+        await self.acker.settle([message for message, _ in outcomes if message.delivery_tag in nacked], acked=False)
+        await self.acker.settle([message for message, _ in outcomes if message.delivery_tag not in nacked])
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Stop taking deliveries, send what has been received, wait up to
+        `timeout` seconds for batches in flight to be settled and close the
+        channel.
+        """
+        if self.consumer_tag:
+            await self.queue.cancel(self.consumer_tag)
+        while self.pending:
+            await self.flush()
+        if self.tasks:
+            done, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            if pending:
+                logger.warning("%s batches from %s were still in flight at shutdown", len(pending), self.queue_name)
+        await self.channel.close()
+
+class Runtime:
+    """
+    Consumers for a changing set of queues, sharing one connection (with a
+    channel per queue) and one set of transports.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.ipn_client = None
+        self.transports = {}
+        self.consumers = {}
+        self.runners = {}
+        self.sampler = None
+        runtimes.append(self)
+
+    async def start(self):
+        self.connection = await aio_pika.connect_robust(
+            host=RABBITMQ_SERVER,
+            port=RABBITMQ_PORT,
+            login=RABBITMQ_USER,
+            password=RABBITMQ_PASS,
+            virtualhost=RABBITMQ_VHOST
+        )
+        self.ipn_client = IPNClient()
+        self.transports = {
+            'koili_ipn_queue': self.ipn_client.send_many,
+            'email_queue': blocking(email_alerts),
+            'sms_queue': blocking(sms_alerts)
+        }
+        self.sampler = asyncio.ensure_future(self._sample_depth())
+
+    async def _sample_depth(self):
+        while True:
+            await asyncio.sleep(QUEUE_DEPTH_INTERVAL)
+            for consumer in list(self.consumers.values()):
                 try:
-                    channel.basic_ack(delivery_tag=method.delivery_tag)
-                except pika.exceptions.AMQPChannelError:
-                    logger.warning(f"Failed to acknowledge message from {queue_name}. Channel might be closed.")
-                    return False
-            message_batches[queue_name].clear()
-    return True
-
-def check_batch_timer(channel, queue_name):
-    while True:
-        time.sleep(BATCH_TIMEOUT)
-        if not process_batch(channel, queue_name):
-            break
-
-def on_message_received(ch, method, properties, body, queue_name):
-    global message_batches
-    with batch_locks[queue_name]:
-        message_batches[queue_name].append((method, body))
-    
-    if len(message_batches[queue_name]) >= BATCH_SIZE:
-        process_batch(ch, queue_name)
+                    # Re-declaring with the same arguments returns the message count
+                    result = await consumer.queue.declare()
+                    consumer.depth = result.message_count
+                except Exception as e:
+                    logger.warning("Failed to sample depth of %s: %s", consumer.queue_name, e)
+
+    async def add(self, queue_name):
+        consumer = QueueConsumer(self.connection, queue_name, self.transports[partitions.base_queue(queue_name)])
+        await consumer.start()
+        self.consumers[queue_name] = consumer
+        self.runners[queue_name] = asyncio.ensure_future(consumer.run())
+
+    async def remove(self, queue_name):
+        """
+        Stop consuming a queue and drain it.
+        """
+        consumer = self.consumers.pop(queue_name)
+        consumer.stop()
+        await self.runners.pop(queue_name)
+        await consumer.drain()
+        logger.info("Stopped consuming from %s", queue_name)
+
+    async def stop(self):
+        self.sampler.cancel()
+        await asyncio.gather(*[self.remove(queue_name) for queue_name in list(self.consumers)])
+        await self.connection.close()
+        await self.ipn_client.close()
+
+def stop_on_signal(stopping):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+def metrics_port(index=0):
+    # Each worker process serves its metrics on its own port
+    return metrics.METRICS_PORT + index if metrics.METRICS_PORT else 0
+
+async def serve_metrics(port):
+    if not port:
+        return
+    try:
+        await metrics.serve(port)
+    except OSError as e:
+        # e.g. another consumer on this host already serves the port
+        logger.warning("Not serving metrics on port %s: %s", port, e)
+
+async def run(queue_names=QUEUES, port=0):
+    """
+    Consume the given queues over a single connection, with one channel per
+    queue, until SIGTERM or SIGINT; then drain and exit.
+    """
+    stopping = asyncio.Event()
+    stop_on_signal(stopping)
+    await serve_metrics(port)
+
+    runtime = Runtime()
+    await runtime.start()
+    try:
+        for queue_name in queue_names:
+            await runtime.add(queue_name)
+        logger.info("Sender started. Processing messages from %s on %s.", list(queue_names), RABBITMQ_SERVER)
+        await stopping.wait()
+        logger.info("Sender stopping...")
+    finally:
+        await runtime.stop()
+
+def run_process(queue_names, index=0):
+    asyncio.run(run(queue_names, metrics_port(index)))
+
+def spawn(target, args, processes):
+    """
+    Run `target(*args, index)` in `processes` child processes and forward
+    SIGTERM and SIGINT to them, so that each one drains before exiting.
+    """
+    workers = [multiprocessing.Process(target=target, args=args + (index,)) for index in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.join()
+
+def main(queue_names=QUEUES, processes=CONSUMER_PROCESSES):
+    """
+    Run the consumer runtime, in this process or in `processes` worker
+    processes that share the queues as competing consumers.
+    """
+    if processes <= 1:
+        run_process(queue_names)
+    else:
+        spawn(run_process, (queue_names,), processes)
 
 def create_channel():
+    """
+    Blocking channel for command line tools such as the retry replay.
+    """
     while True:
         try:
             credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
@@ -139,48 +471,10 @@ def create_channel():
             logger.error(f"Failed to connect to {RABBITMQ_SERVER}. Retrying in 5 seconds...")
             time.sleep(5)
 
-def start_consumer(queue_name):
-    while True:
-        try:
-            connection, channel = create_channel()
-
-            channel.queue_declare(queue=queue_name)
-    
-            channel.basic_consume(
-                queue=queue_name, 
-                on_message_callback=lambda ch, method, properties, body: on_message_received(ch, method, properties, body, queue_name),
-                auto_ack=False
-            )
-
-            # Start the batch timer thread
-            timer_thread = threading.Thread(target=check_batch_timer, args=(channel, queue_name), daemon=True)
-            timer_thread.start()
-
-            logger.info(f"Started consuming from {queue_name}")
-            channel.start_consuming()
-        except pika.exceptions.AMQPChannelError as err:
-            logger.warning(f"Caught a channel error: {err}, reopening...")
-            continue
-        except pika.exceptions.AMQPConnectionError:
-            logger.warning("Connection was closed, reopening...")
-            continue
-        except KeyboardInterrupt:
-            logger.info("Shutting down...")
-            break
-        except Exception as err:
-            logger.error(f"Unexpected error: {err}")
-            break
-
 if __name__ == "__main__":
-    # Start a thread for each queue
-    for queue_name in message_batches.keys():
-        threading.Thread(target=start_consumer, args=(queue_name,), daemon=True).start()
-
-    logger.info(f"Sender started. Processing messages from all queues on {RABBITMQ_SERVER}.")
-
-    # Keep the main thread alive
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("Sender stopping...")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Consume the notification queues")
+    parser.add_argument('--processes', type=int, default=CONSUMER_PROCESSES, help="worker processes to run")
+    parser.add_argument('--queues', nargs='+', default=partitions.shard_queues(QUEUES),
+                        help="queues or shard queues to consume (default: all)")
+    args = parser.parse_args()
+    main(args.queues, args.processes)
@@ -0,0 +1,21 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def database():
+    """
+    A Database on an in-memory mongomock client.
+    """
+    mongomock = pytest.importorskip('mongomock')
+    from db import Database
+
+    database = Database(name='test', client=mongomock.MongoClient())
+    asyncio.run(database.connect())
+    yield database
+    asyncio.run(database.close())
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from breaker import AdaptiveLimiter, CircuitOpenError, ConcurrencyLimitError, Destination
+
+def test_waiting_caller_gets_the_released_slot():
+    limiter = AdaptiveLimiter(1, latency_target=1)
+
+    async def run():
+        assert await limiter.acquire_async()
+        waiter = asyncio.create_task(limiter.acquire_async(timeout=5))
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and len(limiter.waiters) == 1
+        limiter.release(0.001, True)
+        return await waiter
+
+    assert asyncio.run(run())
+    assert limiter.inflight == 1 and not limiter.waiters
+
+def test_thread_waits_for_a_slot():
+    limiter = AdaptiveLimiter(1, latency_target=1)
+    assert limiter.acquire()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(limiter.acquire(timeout=5)))
+    thread.start()
+    while not limiter.waiters:
+        time.sleep(0.001)
+    limiter.release(0.001, True)
+    thread.join()
+    assert results == [True]
+
+def test_backed_off_limit_queues_callers_instead_of_shedding():
+    limiter = AdaptiveLimiter(4, latency_target=1, backoff=0.5)
+    for _ in range(4):
+        assert limiter.acquire()
+    limiter.release(0.001, False)
+    assert int(limiter.limit) == 2
+
+    async def run():
+        waiters = [asyncio.create_task(limiter.acquire_async(timeout=5)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        # Three calls are still in flight above the new limit of two
+        assert not any(waiter.done() for waiter in waiters)
+        for _ in range(3):
+            limiter.release(0.001, True)
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(run()) == [True, True]
+
+def test_timed_out_waiter_passes_on_its_wake_up():
+    limiter = AdaptiveLimiter(1, latency_target=1)
+    assert limiter.acquire()
+    assert not limiter.acquire(timeout=0.01)
+    assert not limiter.waiters and limiter.inflight == 1
+
+def test_destination_sheds_when_no_slot_frees_up():
+    destination = Destination('test_shed', 1, latency_target=1)
+    started = destination.acquire()
+    with pytest.raises(ConcurrencyLimitError):
+        asyncio.run(destination.acquire_async(timeout=0.01))
+    destination.release(started, True)
+    assert destination.shed == 1
+    destination.release(destination.acquire(timeout=0), True)
+
+def test_destination_sheds_while_circuit_is_open():
+    destination = Destination('test_open', 4, latency_target=1, failure_threshold=2, reset_timeout=60)
+    for _ in range(2):
+        destination.release(destination.acquire(), False)
+    with pytest.raises(CircuitOpenError):
+        destination.acquire()
+    assert destination.limiter.inflight == 0
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from bulk import BulkFormatError, BulkParser, BulkTooLargeError
+
+def parse(body, chunk_size, **kwargs):
+    parser = BulkParser(**kwargs)
+    items = []
+    for start in range(0, len(body), chunk_size):
+        items += parser.feed(body[start:start + chunk_size])
+    return items + parser.close()
+
+ITEMS = [{"uniqueId": str(i), "remark1": "a, b] c}", "name": "Kāṭhmāḍauṃ"} for i in range(5)]
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 4096])
+def test_ndjson_split_across_chunks(chunk_size):
+    body = b'\n\n'.join(json.dumps(item, ensure_ascii=False).encode() for item in ITEMS) + b'\n  \n'
+    assert [json.loads(item) for item in parse(body, chunk_size)] == ITEMS
+
+def test_ndjson_last_line_without_newline():
+    assert parse(b'{"a": 1}\n{"a": 2}', 4096) == [b'{"a": 1}', b'{"a": 2}']
+
+def test_ndjson_malformed_line_is_an_item():
+    assert parse(b'{"a": 1}\nnot json\n', 4096) == [b'{"a": 1}', b'not json']
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 4096])
+def test_array_split_across_chunks(chunk_size):
+    # Multi-byte characters and brackets inside strings cross chunk boundaries
+    body = json.dumps(ITEMS, ensure_ascii=False, indent=1).encode()
+    assert [json.loads(item) for item in parse(body, chunk_size)] == ITEMS
+
+def test_empty_bodies():
+    assert parse(b'', 1) == []
+    assert parse(b' [ ] ', 1) == []
+
+@pytest.mark.parametrize('body', [
+    b'[{"a": 1} {"a": 2}]',
+    b'[{"a": 1},',
+    b'[{"a": 1}] []',
+    b'[{"a": 1}, nope]',
+    b'[{"a": "\xff"}]',
+])
+def test_broken_array_framing(body):
+    with pytest.raises(BulkFormatError):
+        parse(body, 4096)
+
+def test_complete_line_over_item_limit():
+    # The oversized line ends inside the chunk that completes it
+    with pytest.raises(BulkFormatError):
+        parse(b'{"a": 1}\n' + b'x' * 200 + b'\n{"a": 2}\n', 4096, max_item_bytes=100)
+
+def test_partial_line_over_item_limit():
+    parser = BulkParser(max_item_bytes=100)
+    parser.feed(b'x' * 60)
+    with pytest.raises(BulkFormatError):
+        parser.feed(b'x' * 60)
+
+def test_partial_array_item_over_item_limit():
+    parser = BulkParser(max_item_bytes=100)
+    with pytest.raises(BulkFormatError):
+        parser.feed(b'[{"a": "' + b'x' * 200)
+
+def test_too_many_items():
+    with pytest.raises(BulkTooLargeError):
+        parse(b'{}\n' * 4, 4096, max_items=3)
+    assert len(parse(b'{}\n' * 3, 4096, max_items=3)) == 3
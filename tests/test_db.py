@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+BASE = datetime(2024, 1, 1)
+
+@pytest.fixture
+def transactions(database):
+    # Several transactions share each timestamp, so pages must break ties
+    database.transactions.insert_many([
+        {"merchantId": "M1", "terminalId": "T1", "uniqueId": str(i),
+         "timestamp": BASE + timedelta(seconds=i // 7), "properties": {"txnDate": BASE + timedelta(days=i % 10)}}
+        for i in range(250)
+    ] + [{"merchantId": "M1", "terminalId": "T2", "uniqueId": "other", "timestamp": BASE, "properties": {}}])
+    return database
+
+def read(database, **kwargs):
+    async def collect():
+        rows = []
+        async for batch in database.stream_transactions("M1", "T1", **kwargs):
+            rows += batch
+        return rows
+    return asyncio.run(collect())
+
+def test_keyset_pages_cover_every_transaction_once(transactions):
+    everything = read(transactions)
+    assert len(everything) == 250
+    assert everything == sorted(everything, key=lambda row: (row['timestamp'], row['_id']), reverse=True)
+
+    paged = []
+    after = None
+    while page := read(transactions, after=after, limit=40, batch_size=15):
+        assert len(page) <= 40
+        paged += page
+        after = (page[-1]['timestamp'], page[-1]['_id'])
+    assert [row['_id'] for row in paged] == [row['_id'] for row in everything]
+
+def test_txn_date_range(transactions):
+    rows = read(transactions, txn_from=BASE + timedelta(days=2), txn_to=BASE + timedelta(days=4))
+    assert len(rows) == 50
+    assert {row['properties']['txnDate'] for row in rows} == {BASE + timedelta(days=2), BASE + timedelta(days=3)}
+
+def test_stream_closes_cursor_when_abandoned(transactions):
+    cursors = []
+    find = transactions.transactions.find
+
+    def tracked(*args, **kwargs):
+        cursor = find(*args, **kwargs)
+        cursor.close = lambda: cursors.append(cursor)
+        return cursor
+
+    async def first_batch():
+        stream = transactions.stream_transactions("M1", "T1", batch_size=10)
+        batch = await stream.__anext__()
+        await stream.aclose()
+        return batch
+
+    transactions.transactions.find = tracked
+    assert len(asyncio.run(first_batch())) == 10
+    assert len(cursors) == 1
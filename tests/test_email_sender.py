@@ -0,0 +1,143 @@
+import json
+import smtplib
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+from twilio.base.exceptions import TwilioRestException
+
+from email_sender import SMSClient, SMTPPool, build_email
+
+class TwilioStandIn(BaseHTTPRequestHandler):
+    """
+    Answers Messages.json like the provider: invalid numbers are refused
+    with 400, numbers ending in 503 find it unavailable.
+    """
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        to = form['To'][0]
+        if to == 'invalid':
+            self.reply(400, {'code': 21211, 'message': f"The 'To' number {to} is not valid", 'status': 400})
+        elif to.endswith('503'):
+            self.reply(503, {'code': 20503, 'message': 'Service unavailable', 'status': 503})
+        else:
+            self.server.sent.append((form['From'][0], to, form['Body'][0]))
+            self.reply(201, {'sid': f"SM{len(self.server.sent)}", 'to': to, 'body': form['Body'][0], 'status': 'queued'})
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def twilio():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TwilioStandIn)
+    server.sent = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def sms(twilio):
+    client = SMSClient(account_sid='ACtest', auth_token='secret', from_='+15005550006',
+                       api_url=f"http://127.0.0.1:{twilio.server_port}", concurrency=4, rate=0)
+    yield client
+    client.close()
+
+def test_send_batch_returns_a_result_per_message(sms, twilio):
+    results = sms.send_batch([('one', '+9779800000001'), ('two', 'invalid'), ('three', '+9779800000003')])
+    assert {results[0].sid, results[2].sid} == {'SM1', 'SM2'}
+    assert isinstance(results[1], TwilioRestException) and results[1].status == 400
+    assert sorted(twilio.sent) == [('+15005550006', '+9779800000001', 'one'), ('+15005550006', '+9779800000003', 'three')]
+
+def test_only_provider_errors_count_against_its_health(sms):
+    results = sms.send_batch([('one', 'invalid'), ('two', '+9779800000503')])
+    assert [result.status for result in results] == [400, 503]
+    assert sms.destination.calls == 2 and sms.destination.failures == 1
+
+class Mailbox:
+    """
+    aiosmtpd handler that keeps the messages it accepts and refuses
+    recipients at refused.test.
+    """
+
+    def __init__(self):
+        self.received = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.endswith('@refused.test'):
+            return '550 No such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received.append(envelope.rcpt_tos[0])
+        return '250 Message accepted for delivery'
+
+class SMTPStandIn:
+    def __init__(self):
+        controller = pytest.importorskip('aiosmtpd.controller')
+        self.Controller = controller.Controller
+        self.mailbox = Mailbox()
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.controller = None
+
+    def start(self):
+        self.controller = self.Controller(self.mailbox, hostname='127.0.0.1', port=self.port)
+        self.controller.start()
+
+    def stop(self):
+        self.controller.stop()
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPStandIn()
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def smtp(smtp_server):
+    pool = SMTPPool(host='127.0.0.1', port=smtp_server.port, size=2, starttls=False, idle_check=3600)
+    yield pool
+    pool.close()
+
+def emails(*recipients):
+    return [build_email('Payment Confirmation', 'A payment was received', to) for to in recipients]
+
+def test_send_batch_refused_recipient_only_fails_itself(smtp, smtp_server):
+    results = smtp.send_batch(emails('a@ok.test', 'b@refused.test', 'c@ok.test', 'd@ok.test'))
+    assert results[0] is None and results[2] is None and results[3] is None
+    assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+    assert sorted(smtp_server.mailbox.received) == ['a@ok.test', 'c@ok.test', 'd@ok.test']
+    # A refused recipient says nothing about the server's health, and the
+    # connections are kept for the next batch
+    assert smtp.destination.failures == 0
+    assert smtp.idle.qsize() == 2
+
+def test_send_batch_reconnects_dropped_sessions(smtp, smtp_server):
+    assert smtp.send_batch(emails('a@ok.test', 'b@ok.test')) == [None, None]
+    # The server restarts: the pooled sessions are dead but look idle
+    smtp_server.stop()
+    smtp_server.start()
+    assert smtp.send_batch(emails('c@ok.test', 'd@ok.test', 'e@ok.test')) == [None, None, None]
+    assert sorted(smtp_server.mailbox.received) == ['a@ok.test', 'b@ok.test', 'c@ok.test', 'd@ok.test', 'e@ok.test']
+
+def test_send_batch_with_server_down(smtp, smtp_server):
+    smtp_server.stop()
+    results = smtp.send_batch(emails('a@ok.test', 'b@ok.test', 'c@ok.test'))
+    assert all(isinstance(result, OSError) for result in results)
+    smtp_server.start()
+    assert smtp.send_batch(emails('d@ok.test')) == [None]
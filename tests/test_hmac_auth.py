@@ -0,0 +1,48 @@
+import pytest
+
+from hmac_auth import NonceCache
+
+NOW = 1_700_000_000.0
+
+def timestamp(seconds):
+    return str(int(seconds * 1000))
+
+def test_timestamp_nonces_must_be_within_window():
+    nonces = NonceCache(window=300)
+    assert nonces.fresh(timestamp(NOW - 299), now=NOW)
+    assert nonces.fresh(timestamp(NOW + 299), now=NOW)
+    assert not nonces.fresh(timestamp(NOW - 301), now=NOW)
+    assert not nonces.fresh(timestamp(NOW + 301), now=NOW)
+
+def test_other_nonces_unless_timestamps_only():
+    assert NonceCache().fresh('0f8fad5b-d9cb-469f', now=NOW)
+    assert not NonceCache(timestamps_only=True).fresh('0f8fad5b-d9cb-469f', now=NOW)
+    assert NonceCache(timestamps_only=True).fresh(timestamp(NOW), now=NOW)
+
+@pytest.mark.parametrize('nonce', ['9' * 400, '9' * 5000])
+def test_huge_numeric_nonces_are_stale(nonce):
+    assert not NonceCache().fresh(nonce, now=NOW)
+
+@pytest.mark.parametrize('nonce', ['²', '١٢٣', '12³'])
+def test_non_ascii_digits_are_not_timestamps(nonce):
+    assert NonceCache().fresh(nonce, now=NOW)
+    assert not NonceCache(timestamps_only=True).fresh(nonce, now=NOW)
+
+def test_replay_is_refused_per_api_key():
+    nonces = NonceCache(window=300)
+    assert nonces.use('key', 'n1', now=NOW)
+    assert not nonces.use('key', 'n1', now=NOW + 1)
+    assert nonces.use('other', 'n1', now=NOW + 1)
+
+def test_nonces_are_forgotten_after_window():
+    nonces = NonceCache(window=300)
+    nonces.use('key', 'n1', now=NOW)
+    nonces.use('key', 'n2', now=NOW + 301)
+    assert ('key', 'n1') not in nonces.seen
+    assert nonces.use('key', 'n1', now=NOW + 302)
+
+def test_size_bounds_the_cache():
+    nonces = NonceCache(window=300, size=2)
+    for nonce in ('n1', 'n2', 'n3'):
+        nonces.use('key', nonce, now=NOW)
+    assert list(nonces.seen) == [('key', 'n2'), ('key', 'n3')]
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from idempotency import IdempotencyStore
+
+def response(n):
+    return {"status": True, "message": "SMS delivered successfully", "code": "0", "data": {"msgId": n}, "httpStatus": 200}
+
+@pytest.fixture
+def store(database):
+    store = IdempotencyStore(database)
+    asyncio.run(store.start())
+    return store
+
+def test_claim_many_first_and_repeated_keys(store):
+    results = asyncio.run(store.claim_many([('a', response(1)), ('b', response(2)), ('a', response(3))]))
+    assert results == [None, None, response(1)]
+    assert store.duplicates == 1
+    # Answered from memory the second time
+    assert asyncio.run(store.claim_many([('b', response(4))])) == [response(2)]
+
+def test_claim_many_finds_keys_claimed_elsewhere(store, database):
+    asyncio.run(store.claim_many([('a', response(1))]))
+    other = IdempotencyStore(database)
+    assert asyncio.run(other.claim_many([('c', response(3)), ('a', response(4))])) == [None, response(1)]
+    assert database.idempotency.find_one({"_id": 'a'})['response'] == response(1)
+
+def test_claim_many_failure_releases_stored_keys(store, database):
+    insert = database.insert_idempotency_keys
+
+    async def partly_failing(documents):
+        # The first document is stored, the second fails validation
+        await insert(documents[:1])
+        raise BulkWriteError({'writeErrors': [{'index': 1, 'code': 121, 'errmsg': 'validation'}]})
+
+    database.insert_idempotency_keys = partly_failing
+    with pytest.raises(BulkWriteError):
+        asyncio.run(store.claim_many([('a', response(1)), ('b', response(2))]))
+    database.insert_idempotency_keys = insert
+    assert database.idempotency.count_documents({}) == 0
+    assert asyncio.run(store.claim_many([('a', response(1))])) == [None]
+
+def test_release_many_lets_retries_through(store):
+    asyncio.run(store.claim_many([('a', response(1)), ('b', response(2))]))
+    asyncio.run(store.release_many(['a']))
+    assert asyncio.run(store.claim_many([('a', response(3)), ('b', response(4))])) == [None, response(2)]
+
+def test_find_many_does_not_claim(store, database):
+    asyncio.run(store.claim_many([('a', response(1))]))
+    other = IdempotencyStore(database)
+    assert other.recall_many(['a', 'b']) == [None, None]
+    assert asyncio.run(other.find_many(['a', 'b', 'a'])) == [response(1), None, response(1)]
+    assert other.recall_many(['a']) == [response(1)]
+    assert database.idempotency.find_one({"_id": 'b'}) is None
@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from koili_ipn import IPNClient
+
+def client(handler):
+    ipn = IPNClient(endpoint='http://ipn.test/notify', concurrency=4)
+    ipn.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return ipn
+
+def send_many(ipn, notifications):
+    async def run():
+        try:
+            return await ipn.send_many(notifications)
+        finally:
+            await ipn.close()
+    return asyncio.run(run())
+
+def test_one_bad_item_only_fails_itself():
+    posted = []
+
+    def handler(request):
+        posted.append(json.loads(request.content))
+        return httpx.Response(200, json={'message': 'ok', 'responseCode': '000'})
+
+    results = send_many(client(handler), [('10', 'm1'), ('1.2.3', 'm2'), ('10', 'm3')])
+    assert results == [True, False, True]
+    assert posted == [{'amount': 10.0, 'machineIdentifier': 'm1'}, {'amount': 10.0, 'machineIdentifier': 'm3'}]
+
+@pytest.mark.parametrize('response', [
+    httpx.Response(200, text='accepted'),
+    httpx.Response(200, json={'status': 'ok'}),
+    httpx.Response(200, json=['ok']),
+])
+def test_accepted_with_unexpected_body(response):
+    assert send_many(client(lambda request: response), [('10', 'm1')]) == [True]
+
+def test_errors_and_rejections_fail_their_item():
+    def handler(request):
+        machine_identifier = json.loads(request.content)['machineIdentifier']
+        if machine_identifier == 'down':
+            raise httpx.ConnectError('refused', request=request)
+        if machine_identifier == 'bad':
+            return httpx.Response(400, text='bad request')
+        return httpx.Response(200, json={'message': 'ok', 'responseCode': '000'})
+
+    ipn = client(handler)
+    assert send_many(ipn, [('1', 'down'), ('1', 'bad'), ('1', 'm1')]) == [False, False, True]
+    # A rejected request says nothing about the endpoint's health
+    assert ipn.destination.failures == 1
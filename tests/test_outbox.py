@@ -0,0 +1,84 @@
+import asyncio
+
+from outbox import OutboxRelay
+
+class Records:
+    """
+    Stand-in for the Database outbox methods: a dict of record id to status.
+    """
+
+    def __init__(self, count):
+        self.status = {index: 'pending' for index in range(count)}
+
+    async def claim_dispatches(self, owner, limit, now, expired):
+        claimed = [index for index, status in self.status.items() if status == 'pending'][:limit]
+        for index in claimed:
+            self.status[index] = 'claimed'
+        return [{'_id': index, 'dispatch': {'message': {}, 'messageId': str(index)}} for index in claimed]
+
+    async def mark_dispatched(self, ids, now):
+        self.status.update(dict.fromkeys(ids, 'sent'))
+
+    async def release_dispatches(self, ids):
+        self.status.update(dict.fromkeys(ids, 'pending'))
+
+class Dispatcher:
+    def __init__(self, unreachable=0):
+        self.unreachable = unreachable
+        self.attempts = 0
+        self.published = []
+
+    async def start(self):
+        self.attempts += 1
+        if self.attempts <= self.unreachable:
+            raise ConnectionError('broker down')
+
+    async def dispatch_many(self, notifications):
+        self.published += [message_id for _, message_id in notifications]
+        return [True] * len(notifications)
+
+def relay(records, dispatcher):
+    return OutboxRelay(records, dispatcher, batch_size=2, poll_interval=0.01, connect_retry=0.01)
+
+def test_relay_retries_until_the_broker_is_reachable():
+    records = Records(5)
+    dispatcher = Dispatcher(unreachable=3)
+    outbox = relay(records, dispatcher)
+
+    async def run():
+        await outbox.start()
+        while len(dispatcher.published) < 5:
+            await asyncio.sleep(0.01)
+        await outbox.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert dispatcher.attempts == 4
+    assert set(records.status.values()) == {'sent'}
+
+def test_stop_while_unreachable_leaves_records_pending():
+    records = Records(3)
+    dispatcher = Dispatcher(unreachable=10 ** 6)
+    outbox = relay(records, dispatcher)
+
+    async def run():
+        await outbox.start()
+        await asyncio.sleep(0.05)
+        await outbox.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert dispatcher.attempts > 1 and not dispatcher.published
+    assert set(records.status.values()) == {'pending'}
+
+def test_stop_relays_what_is_left():
+    records = Records(5)
+    dispatcher = Dispatcher()
+    outbox = OutboxRelay(records, dispatcher, batch_size=2, poll_interval=60)
+
+    async def run():
+        await outbox.start()
+        await asyncio.sleep(0)
+        records.status.update({index: 'pending' for index in range(5, 8)})
+        await outbox.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert set(records.status.values()) == {'sent'} and len(dispatcher.published) == 8
@@ -0,0 +1,65 @@
+import asyncio
+import itertools
+
+import aio_pika
+import pytest
+from pamqp.commands import Basic
+
+from publisher import PublisherPool
+
+class Exchange:
+    """
+    Confirms every message except those whose body starts with b'nack'.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        await asyncio.sleep(0)
+        if message.body.startswith(b'nack'):
+            raise aio_pika.exceptions.DeliveryError(message, Basic.Nack(delivery_tag=len(self.published) + 1))
+        self.published.append((routing_key, message))
+
+class Channel:
+    def __init__(self):
+        self.default_exchange = Exchange()
+        self.declared = []
+
+    async def declare_queue(self, name, **kwargs):
+        self.declared.append((name, kwargs))
+
+@pytest.fixture
+def pool():
+    pool = PublisherPool()
+    pool.channels = [Channel()]
+    pool._next_channel = itertools.cycle(pool.channels)
+    return pool
+
+def test_publish_many_returns_each_confirm_failure(pool):
+    results = asyncio.run(pool.publish_many([
+        ('sms_queue', b'one', {}),
+        ('sms_queue', b'nack two', {}),
+        ('email_queue', b'three', {'content_type': 'application/json'}),
+    ]))
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], aio_pika.exceptions.DeliveryError)
+    assert pool.stats.published == 2 and pool.stats.failed == 1
+
+    published = pool.channels[0].default_exchange.published
+    assert [(queue_name, message.body) for queue_name, message in published] == \
+        [('sms_queue', b'one'), ('email_queue', b'three')]
+    assert all(message.delivery_mode == aio_pika.DeliveryMode.PERSISTENT for _, message in published)
+    assert published[1][1].content_type == 'application/json'
+
+def test_queues_are_declared_durable_once(pool):
+    asyncio.run(pool.publish_many([('sms_queue', b'one', {}), ('sms_queue', b'two', {})]))
+    asyncio.run(pool.publish_many([('sms_queue', b'three', {})]))
+    declared = pool.channels[0].declared
+    assert [name for name, _ in declared] == ['sms_queue']
+    assert declared[0][1]['durable']
+
+def test_publish_batch_raises_after_the_whole_batch(pool):
+    with pytest.raises(aio_pika.exceptions.DeliveryError):
+        asyncio.run(pool.publish_batch([('sms_queue', b'nack one'), ('sms_queue', b'two')]))
+    assert [message.body for _, message in pool.channels[0].default_exchange.published] == [b'two']
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from rate_limit import MemoryBuckets, RequestLimiter
+
+def limiter(terminal=(0.001, 2), mobile=(0.001, 2), bulk=(0.001, 3)):
+    return RequestLimiter(backend='memory', terminal=terminal, mobile=mobile, bulk=bulk)
+
+def test_acquire_many_in_order():
+    limits = limiter(mobile=(0, 0))
+    results = asyncio.run(limits.acquire_many([('M1', 'T1', '98%08d' % i) for i in range(3)]))
+    assert results[:2] == [None, None]
+    name, retry_after = results[2]
+    assert name == 'terminal'
+    assert retry_after == pytest.approx(1 / 0.001, rel=0.01)
+    assert limits.limited == 1
+
+def test_refused_request_takes_no_token_from_its_other_bucket():
+    limits = limiter(terminal=(0.001, 3), mobile=(0.001, 1))
+    requests = [('M1', 'T1', '9800000000'), ('M1', 'T1', '9800000000'), ('M1', 'T1', '9800000001')]
+    results = asyncio.run(limits.acquire_many(requests))
+    assert results[0] is None and results[2] is None
+    assert results[1][0] == 'mobile'
+    # The terminal token granted to the refused request was put back
+    assert asyncio.run(limits.acquire('M1', 'T1', '9800000002')) is None
+    assert asyncio.run(limits.acquire('M1', 'T1', '9800000003'))[0] == 'terminal'
+
+def test_bulk_items_have_their_own_terminal_bucket():
+    limits = limiter(mobile=(0, 0))
+    requests = [('M1', 'T1', '98%08d' % i) for i in range(4)]
+    assert [result and result[0] for result in asyncio.run(limits.acquire_many(requests, bulk=True))] == \
+        [None, None, None, 'bulk']
+    # Single requests of the terminal are unaffected
+    assert asyncio.run(limits.acquire('M1', 'T1', '9800000000')) is None
+
+def test_disabled_limits_let_everything_through():
+    limits = limiter(terminal=(0, 0), mobile=(0, 0), bulk=(0, 0))
+    assert asyncio.run(limits.acquire_many([('M1', 'T1', '9800000000')] * 100)) == [None] * 100
+
+def test_unavailable_backend_lets_requests_through():
+    class Broken(MemoryBuckets):
+        async def take(self, requests, now=None):
+            raise ConnectionError('down')
+
+    limits = limiter()
+    limits.buckets = Broken()
+    assert asyncio.run(limits.acquire_many([('M1', 'T1', '9800000000')] * 5)) == [None] * 5
+
+def test_memory_buckets_refill():
+    buckets = MemoryBuckets()
+    assert asyncio.run(buckets.take([('b', 2, 4, 6)], now=0)) == [(4, 0)]
+    assert asyncio.run(buckets.take([('b', 2, 4, 6)], now=1.5)) == [(3, 0)]
+    assert asyncio.run(buckets.take([('b', 2, 4, 1)], now=100)) == [(1, 3)]
+
+def test_memory_buckets_forget_least_recently_used():
+    buckets = MemoryBuckets(size=2)
+    asyncio.run(buckets.take([('a', 1, 1, 1), ('b', 1, 1, 1), ('c', 1, 1, 1)], now=0))
+    assert list(buckets.buckets) == ['b', 'c']
@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+from sender import RangeAcker, parse_message
+
+class Message:
+    def __init__(self, channel, delivery_tag, acks):
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+        self.acks = acks
+
+    async def ack(self, multiple=False):
+        self.acks.append((self.channel, self.delivery_tag, multiple))
+
+def deliver(acker, channel, tags, acks):
+    messages = {tag: Message(channel, tag, acks) for tag in tags}
+    for message in messages.values():
+        acker.track(message)
+    return messages
+
+def test_out_of_order_batches_ack_contiguous_ranges():
+    acks = []
+    acker = RangeAcker()
+    messages = deliver(acker, 'channel', range(1, 7), acks)
+    asyncio.run(acker.settle([messages[3], messages[4]]))
+    assert acks == []
+    asyncio.run(acker.settle([messages[1], messages[2]]))
+    assert acks == [('channel', 4, True)]
+    asyncio.run(acker.settle([messages[6]]))
+    asyncio.run(acker.settle([messages[5]]))
+    assert acks[1:] == [('channel', 6, True)]
+
+def test_range_ack_stops_short_of_nacked_messages():
+    acks = []
+    acker = RangeAcker()
+    messages = deliver(acker, 'channel', range(1, 4), acks)
+    asyncio.run(acker.settle([messages[1]]))
+    asyncio.run(acker.settle([messages[2], messages[3]], acked=False))
+    assert acks == [('channel', 1, True)]
+    assert acker.acked == 3
+
+def test_reopened_channel_starts_a_new_range():
+    acks = []
+    acker = RangeAcker()
+    old = deliver(acker, 'old', range(1, 3), acks)
+    new = deliver(acker, 'new', range(1, 3), acks)
+    # Messages of the old channel are redelivered, never acked
+    asyncio.run(acker.settle([old[1], old[2], new[2]]))
+    assert acks == []
+    asyncio.run(acker.settle([new[1]]))
+    assert acks == [('new', 2, True)]
+
+def test_ipn_amounts_float_rejects_are_invalid():
+    body = json.dumps({'amount': '1.2.3', 'machineIdentifier': 'm1'}).encode()
+    assert parse_message('koili_ipn_queue', body) is None
+    body = json.dumps({'amount': '40.0', 'machineIdentifier': 'm1'}).encode()
+    assert parse_message('koili_ipn_queue', body) == (40.0, 'm1')
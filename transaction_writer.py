@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+import time
+import metrics
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Write-behind configuration
+TXN_BATCH_SIZE = int(os.getenv('TXN_BATCH_SIZE', 500))
+TXN_FLUSH_INTERVAL = float(os.getenv('TXN_FLUSH_INTERVAL', 0.05))
+TXN_MAX_PENDING = int(os.getenv('TXN_MAX_PENDING', 10000))
+# Retries of a batch after a connection error or failover, with doubling delays
+TXN_WRITE_RETRIES = int(os.getenv('TXN_WRITE_RETRIES', 3))
+TXN_RETRY_DELAY = float(os.getenv('TXN_RETRY_DELAY', 0.1))
+
+INSERT_STAGE = metrics.STAGE_LATENCY.labels('insert')
+FLUSH_SIZE = metrics.Histogram('transaction_flush_size', 'Transactions per insert_many', buckets=metrics.SIZE_BUCKETS)
+PERSISTED = metrics.Counter('transactions_persisted', 'Transactions written by result', ('result',))
+
+class TransactionWriter:
+    """
+    Write-behind buffer for transaction records. Records are queued by the
+    request handlers and flushed with a single unordered insert_many once
+    the batch is full or the flush interval has passed. When the buffer is
+    full, writers wait for space (backpressure). write() only returns once
+    the batch containing the record has been acknowledged, and raises if
+    the record could not be stored.
+    `on_flush` is called after each batch that was at least partly stored.
+
+    A batch that fails with a connection error is sent again up to
+    `retries` times. Records get their _id before the first attempt, so a
+    duplicate _id on a retry means an earlier attempt stored the record.
+    """
+
+    def __init__(self, db, batch_size=TXN_BATCH_SIZE, flush_interval=TXN_FLUSH_INTERVAL,
+                 max_pending=TXN_MAX_PENDING, on_flush=None,
+                 retries=TXN_WRITE_RETRIES, retry_delay=TXN_RETRY_DELAY):
+        self.db = db
+        self.on_flush = on_flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.task = None
+        self.flushed = 0
+        self.failed = 0
+
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Flush everything still buffered and stop the background task.
+        """
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    async def write(self, transaction):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((transaction, future))
+        await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def write_many(self, transactions):
+        """
+        Insert a batch of transactions directly, bypassing the buffer (for
+        bulk requests, which are already batched). Returns, per
+        transaction, None when it was stored, otherwise the exception.
+        """
+        failed = await self._insert(transactions)
+        return [failed.get(index) for index in range(len(transactions))]
+
+    async def _insert(self, documents):
+        """
+        insert_many a batch. Returns the exceptions of the documents that
+        were not stored, by index.
+        """
+        started = time.perf_counter()
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            failed = {}
+            try:
+                await self.db.insert_transactions(documents)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    if not (attempt and error.get('code') == 11000):
+                        failed[error['index']] = e
+            except ConnectionFailure as e:
+                failed = {index: e for index in range(len(documents))}
+                if attempt < self.retries:
+                    logger.warning("Retrying %s transactions after a connection error: %s", len(documents), e)
+                    continue
+            except Exception as e:
+                failed = {index: e for index in range(len(documents))}
+            break
+
+        if failed:
+            logger.error(f"Failed to persist {len(failed)} of {len(documents)} transactions: {str(next(iter(failed.values())))}")
+        INSERT_STAGE.observe(time.perf_counter() - started)
+        FLUSH_SIZE.observe(len(documents))
+        PERSISTED.labels('success').inc(len(documents) - len(failed))
+        PERSISTED.labels('failure').inc(len(failed))
+        self.flushed += len(documents) - len(failed)
+        self.failed += len(failed)
+        if self.on_flush is not None and len(failed) < len(documents):
+            self.on_flush()
+        return failed
+
+    async def _flush(self, batch):
+        failed = await self._insert([transaction for transaction, _ in batch])
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(None)
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+import partitions
+import sender
+from db import Database
+from dispatcher import QUEUES
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Group membership. Workers heartbeat into the `workers` collection and are
+# considered gone when they miss WORKER_TIMEOUT seconds of heartbeats, so
+# node clocks must be kept in sync (NTP).
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', 5))
+WORKER_TIMEOUT = float(os.getenv('WORKER_TIMEOUT', 15))
+
+class WorkerGroup:
+    """
+    Member of a group of sender workers that share the shard queues. Every
+    worker heartbeats, reads the list of live workers and consumes the
+    shards it owns by rendezvous hashing, so each shard (and with it each
+    merchant) is consumed by exactly one worker. When workers join or leave,
+    each worker first drains and releases the shards it lost, then picks up
+    the ones it gained; the shard queues' single-active-consumer flag keeps
+    the new owner on standby until the old one has let go. Heartbeats run
+    in their own task, so a drain that outlasts WORKER_TIMEOUT does not get
+    the worker dropped from the group.
+    """
+
+    def __init__(self, db, runtime, worker_id=None, queue_names=QUEUES, partition_count=partitions.PARTITIONS):
+        self.db = db
+        self.runtime = runtime
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.shards = partitions.shard_queues(queue_names, partition_count)
+        self.members = []
+
+    async def heartbeat(self):
+        await self.db.heartbeat_worker(self.worker_id, datetime.now(), host=socket.gethostname(), pid=os.getpid())
+
+    async def rebalance(self):
+        members = await self.db.live_workers(datetime.now() - timedelta(seconds=WORKER_TIMEOUT))
+        if self.worker_id not in members:
+            members = sorted(members + [self.worker_id])
+        if members != self.members:
+            logger.info("Worker group is now %s", members)
+            self.members = members
+
+        owned = set(partitions.assign(self.shards, members, self.worker_id))
+        current = set(self.runtime.consumers)
+        await asyncio.gather(*[self.runtime.remove(queue_name) for queue_name in current - owned])
+        for queue_name in owned - current:
+            await self.runtime.add(queue_name)
+
+    async def _every(self, interval, step, stopping, action):
+        while not stopping.is_set():
+            try:
+                await step()
+            except Exception as e:
+                logger.error(f"Failed to {action} worker {self.worker_id}: {str(e)}")
+            try:
+                await asyncio.wait_for(stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, stopping):
+        await self.heartbeat()
+        heartbeats = asyncio.create_task(self._every(WORKER_HEARTBEAT_INTERVAL, self.heartbeat, stopping, 'heartbeat'))
+        try:
+            await self._every(WORKER_HEARTBEAT_INTERVAL, self.rebalance, stopping, 'rebalance')
+        finally:
+            heartbeats.cancel()
+            # Leave the group straight away rather than after WORKER_TIMEOUT
+            await self.db.remove_worker(self.worker_id)
+
+async def run_worker(port=0):
+    stopping = asyncio.Event()
+    sender.stop_on_signal(stopping)
+    await sender.serve_metrics(port)
+
+    db = Database()
+    await db.connect()
+    runtime = sender.Runtime()
+    await runtime.start()
+    try:
+        await WorkerGroup(db, runtime).run(stopping)
+    finally:
+        await runtime.stop()
+        await db.close()
+
+def run_process(index=0):
+    asyncio.run(run_worker(sender.metrics_port(index)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run sender workers that share the partitioned queues")
+    parser.add_argument('--processes', type=int, default=sender.CONSUMER_PROCESSES, help="workers to run on this node")
+    args = parser.parse_args()
+
+    if not partitions.PARTITIONS:
+        parser.error("set PARTITIONS to the number of shard queues per work queue")
+    if args.processes <= 1:
+        run_process()
+    else:
+        sender.spawn(run_process, (), args.processes)